@@ -0,0 +1,111 @@
+import hashlib
+import os
+
+import torch
+
+from benchmarking.inception import myInceptionV3
+
+
+def polynomial_kernel(x, y):
+    """KID kernel k(x,y) = (<x,y>/d + 1)^3"""
+    return (x @ y.T / x.shape[1] + 1) ** 3
+
+
+class RunningStatistics:
+    """
+    Accumulate in float64 and batch by batch everything needed for FID (feature sum and sum of outer products) and for
+    KID (kernel sums over the first 'kid_max_samples' features)
+    """
+    def __init__(self, kid_max_samples=1000):
+        self.kid_max_samples = kid_max_samples
+        self.n = 0
+        self.sum = None
+        self.sum_outer = None
+        self.kid_features = None  # at most kid_max_samples features
+        self.kid_kernel_sum = 0.0  # sum of k(x_i, x_j) over i != j within kid_features
+
+    def update(self, features):
+        features = features.reshape(len(features), -1).double().cpu()
+        if self.sum is None:
+            self.sum = torch.zeros(features.shape[1], dtype=torch.float64)
+            self.sum_outer = torch.zeros(features.shape[1], features.shape[1], dtype=torch.float64)
+            self.kid_features = features[:0]
+        self.n += len(features)
+        self.sum += features.sum(0)
+        self.sum_outer += features.T @ features
+
+        new_kid_features = features[:self.kid_max_samples - len(self.kid_features)]
+        if len(new_kid_features):
+            K = polynomial_kernel(new_kid_features, new_kid_features)
+            self.kid_kernel_sum += (K.sum() - K.diagonal().sum()).item()
+            self.kid_kernel_sum += 2 * polynomial_kernel(new_kid_features, self.kid_features).sum().item()
+            self.kid_features = torch.cat([self.kid_features, new_kid_features])
+
+    def mean_and_covariance(self):
+        mu = self.sum / self.n
+        cov = (self.sum_outer - self.n * torch.outer(mu, mu)) / (self.n - 1)
+        return mu, cov
+
+    def state_dict(self):
+        return self.__dict__.copy()
+
+    def load_state_dict(self, state_dict):
+        self.__dict__.update(state_dict)
+
+
+def frechet_distance(mu1, cov1, mu2, cov2):
+    """||mu1 - mu2||^2 + Tr(cov1 + cov2 - 2 sqrt(cov1 cov2)) where Tr(sqrt(cov1 cov2)) is computed from the eigenvalues of
+    the symmetric PSD matrix sqrt(cov1) cov2 sqrt(cov1)"""
+    eigvals, eigvecs = torch.linalg.eigh(cov1)
+    sqrt_cov1 = eigvecs @ torch.diag(eigvals.clamp(min=0).sqrt()) @ eigvecs.T
+    tr_covmean = torch.linalg.eigvalsh(sqrt_cov1 @ cov2 @ sqrt_cov1).clamp(min=0).sqrt().sum()
+    return ((mu1 - mu2) ** 2).sum() + torch.trace(cov1) + torch.trace(cov2) - 2 * tr_covmean
+
+
+def kernel_inception_distance(stats_x, stats_y):
+    """Unbiased MMD^2 estimate with the polynomial kernel over the features kept by the two RunningStatistics"""
+    m, n = len(stats_x.kid_features), len(stats_y.kid_features)
+    if m < 2 or n < 2:
+        raise ValueError(f"KID needs at least 2 samples of each set, got {m} and {n}")
+    cross_sum = polynomial_kernel(stats_x.kid_features, stats_y.kid_features).sum().item()
+    return stats_x.kid_kernel_sum / (m * (m - 1)) + stats_y.kid_kernel_sum / (n * (n - 1)) - 2 * cross_sum / (m * n)
+
+
+class FIDEvaluator:
+    """
+    Compute FID and KID of generated images against real-data Inception statistics that are computed once and cached
+    to disk. Generated images are streamed through the network batch by batch so memory does not depend on their number
+    """
+    def __init__(self, device, weights_path=None, kid_max_samples=1000, cache_dir=os.path.join("outputs", "fid_stats")):
+        self.device = device
+        self.inception = myInceptionV3(weights_path).to(device)
+        self.kid_max_samples = kid_max_samples
+        self.cache_dir = cache_dir
+        self.reference_stats = None
+
+    def compute_statistics(self, batches):
+        stats = RunningStatistics(self.kid_max_samples)
+        with torch.inference_mode():
+            for batch in batches:
+                stats.update(self.inception(batch.to(self.device)))
+        return stats
+
+    def load_reference(self, real_batches, dataset_id):
+        """Load the cached statistics of the real data named 'dataset_id' or compute them from 'real_batches'"""
+        # Statistics depend on the data, the Inception weights and the number of features kept for KID
+        key = hashlib.sha1(str((dataset_id, self.inception.weights_path, self.kid_max_samples)).encode()).hexdigest()[:16]
+        path = os.path.join(self.cache_dir, f"{key}.pt")
+        self.reference_stats = RunningStatistics(self.kid_max_samples)
+        if os.path.exists(path):
+            self.reference_stats.load_state_dict(torch.load(path))
+        else:
+            self.reference_stats = self.compute_statistics(real_batches)
+            os.makedirs(self.cache_dir, exist_ok=True)
+            torch.save(self.reference_stats.state_dict(), path + ".tmp")
+            os.replace(path + ".tmp", path)
+
+    def __call__(self, fake_batches):
+        fake_stats = self.compute_statistics(fake_batches)
+        fid = frechet_distance(*fake_stats.mean_and_covariance(), *self.reference_stats.mean_and_covariance())
+        kid = kernel_inception_distance(fake_stats, self.reference_stats)
+        return {"FID": fid.item(), "KID": kid}
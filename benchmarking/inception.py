@@ -0,0 +1,40 @@
+import os
+
+import torch
+import torch.nn.functional as F
+from torch import nn
+
+DEFAULT_WEIGHTS_PATH = os.path.join(os.path.dirname(__file__), "..", "pretrained_models", "inception_v3.pth")
+
+
+class myInceptionV3(nn.Module):
+    """
+    torchvision's InceptionV3 returning the 2048-d pooled features of images in [-1, 1].
+    The IMAGENET1K_V1 weights were trained on inputs in [-1, 1] (torchvision maps ImageNet-normalized inputs back to that
+    range with transform_input=True) so images are fed as they are.
+    Weights are read from a local state_dict file (weights_path, $INCEPTION_WEIGHTS or DEFAULT_WEIGHTS_PATH) so that
+    evaluation runs offline. Such a file can be created once with
+    torch.save(torchvision.models.inception_v3(weights='IMAGENET1K_V1').state_dict(), path)
+    """
+    def __init__(self, weights_path=None):
+        super(myInceptionV3, self).__init__()
+        from torchvision.models import inception_v3
+        if weights_path is None:
+            weights_path = os.environ.get("INCEPTION_WEIGHTS", DEFAULT_WEIGHTS_PATH)
+        if not os.path.exists(weights_path):
+            raise FileNotFoundError(f"No InceptionV3 weights found at {weights_path}")
+        self.weights_path = os.path.abspath(weights_path)
+
+        self.model = inception_v3(weights=None, aux_logits=False, init_weights=False, transform_input=False)
+        state_dict = torch.load(weights_path, map_location="cpu")
+        state_dict = {k: v for k, v in state_dict.items() if not k.startswith("AuxLogits")}
+        self.model.load_state_dict(state_dict)
+        self.model.fc = nn.Identity()
+        self.model.eval()
+        self.model.requires_grad_(False)
+
+    def forward(self, x):
+        if x.shape[1] == 1:
+            x = x.repeat(1, 3, 1, 1)
+        x = F.interpolate(x, size=(299, 299), mode='bilinear', align_corners=False)
+        return self.model(x)
@@ -0,0 +1 @@
+# Makes the repository root importable by the tests
@@ -4,6 +4,7 @@ import torch
 import torch.nn.functional as F
 
 from utils import distribution_metrics
+from utils.metrics import vgg_dist_calculator
 
 
 def to_patches(x, p=8, s=4, sample_patches=None, remove_locations=True):
@@ -20,19 +21,34 @@ def to_patches(x, p=8, s=4, sample_patches=None, remove_locations=True):
 
 
 class MiniBatchLoss:
+    streamable = True  # compute(x, y) compares to_samples(x) and to_samples(y)
+    cache = None  # A FeatureCache for the features of fixed reference sets (used by losses on deep features)
+
     def __init__(self, dist='w1', **kwargs):
         self.metric = getattr(distribution_metrics, dist)
         self.kwargs = kwargs
 
+    def to_samples(self, x):
+        return x.reshape(len(x), -1)
+
     def compute(self, x, y):
-        return self.metric(x.reshape(len(x), -1),
-                           y.reshape(len(y), -1),
+        return self.metric(self.to_samples(x),
+                           self.to_samples(y),
                            **self.kwargs)
 
-    def __call__(self, images_X, images_Y):
+    def __call__(self, images_X, images_Y, Y_id=None):
+        """Y_id names images_Y as a fixed set (e.g the train data) whose features can be cached"""
         with torch.no_grad():
             return self.compute(images_X, images_Y)[0]
 
+    def from_batches(self, X_batches, images_Y, Y_id=None):
+        """Same as __call__ with the concatenation of X_batches. The swd only keeps the projections of each batch"""
+        with torch.no_grad():
+            if self.streamable and self.metric is distribution_metrics.swd:
+                X_samples = (self.to_samples(x) for x in X_batches)
+                return distribution_metrics.streaming_swd(X_samples, self.to_samples(images_Y), **self.kwargs)[0]
+            return self(torch.cat(list(X_batches)), images_Y, Y_id)
+
     def trainD(self, netD, real_data, fake_data):
         raise NotImplemented("MiniBatchLosses should be run with --n_D_steps 0")
 
@@ -46,11 +62,10 @@ class MiniBatchPatchLoss(MiniBatchLoss):
         self.p = int(p)
         self.s = int(s)
         self.n_samples = n_samples
+        self.streamable = n_samples is None  # Patches are sampled from the whole set
 
-    def compute(self, x, y):
-        x_patches = to_patches(x, self.p, self.s, self.n_samples)
-        y_patches = to_patches(y, self.p, self.s, self.n_samples)
-        return self.metric(x_patches, y_patches, **self.kwargs)
+    def to_samples(self, x):
+        return to_patches(x, self.p, self.s, self.n_samples)
 
 
 class MiniBatchMSPatchLoss:
@@ -78,6 +93,8 @@ class MiniBatchMSPatchLoss:
 
 
 class MiniBatchLocalPatchLoss(MiniBatchLoss):
+    streamable = False
+
     def __init__(self, dist='w1', p=5, s=1, n_samples=None, **kwargs):
         super(MiniBatchLocalPatchLoss, self).__init__(dist,  **kwargs)
         self.dist_name = dist
@@ -90,4 +107,50 @@ class MiniBatchLocalPatchLoss(MiniBatchLoss):
         y_patches = to_patches(y, self.p, self.s, self.n_samples, remove_locations=False)
         n_locs, _, _ = x_patches.shape
         loss = torch.stack([self.metric(x_patches[l], y_patches[l], **self.kwargs)[0] for l in range(n_locs)]).mean()
-        return loss, {f"Local-{self.dist_name}": loss.item()}
\ No newline at end of file
+        return loss, {f"Local-{self.dist_name}": loss.detach()}
+
+
+class MiniBatchVGGLoss(MiniBatchLoss):
+    """Compare VGG features at several depths extracted in a single forward pass.
+    In patch mode every spatial location of a feature map is a sample (a deep patch), otherwise whole maps are compared"""
+    streamable = False
+
+    def __init__(self, dist='swd', layers='[4, 9, 18]', patch_features='True', b=64, **kwargs):
+        super(MiniBatchVGGLoss, self).__init__(dist,  **kwargs)
+        self.dist_name = dist
+        self.layers = json.loads(layers)
+        self.patch_features = patch_features == 'True'
+        self.b = int(b)
+        self.vgg = None
+
+    def features(self, x):
+        if self.vgg is None:
+            self.vgg = vgg_dist_calculator()
+        if x.shape[1] == 1:
+            x = x.repeat(1, 3, 1, 1)
+        x = self.vgg.normalize((x + 1) / 2)
+        grad = torch.is_grad_enabled() and x.requires_grad
+        features = self.vgg.extract_layers(x, self.layers, b=self.b, grad=grad)
+        if self.patch_features:
+            return {l: f.permute(0, 2, 3, 1).reshape(-1, f.shape[1]) for l, f in features.items()}
+        return {l: f.reshape(len(f), -1) for l, f in features.items()}
+
+    @property
+    def features_name(self):
+        return f"vgg19-IMAGENET1K_V1-imagenet_normalized-layers={self.layers}-patch_features={self.patch_features}"
+
+    def compare(self, x_features, y_features):
+        losses = [self.metric(x_features[l], y_features[l], **self.kwargs)[0] for l in self.layers]
+        loss = torch.stack(losses).mean()
+        return loss, {f"VGG-{self.dist_name}-{l}": l_loss.detach() for l, l_loss in zip(self.layers, losses)}
+
+    def compute(self, x, y):
+        return self.compare(self.features(x), self.features(y))
+
+    def __call__(self, images_X, images_Y, Y_id=None):
+        """With a cache the features of a named Y are extracted once (its samples are compared as a set)"""
+        if self.cache is None or Y_id is None:
+            return super(MiniBatchVGGLoss, self).__call__(images_X, images_Y)
+        with torch.no_grad():
+            y_features = self.cache.get(self.features_name, Y_id, lambda: self.features(images_Y))
+            return self.compare(self.features(images_X), y_features)[0]
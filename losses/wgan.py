@@ -1,15 +1,29 @@
+from utils.train_utils import calc_fused_wgan_gp
+
 
 class WGANLoss:
     """Should be used with GP"""
+    per_sample_loss = True  # Losses are means of per-sample scores: they can be accumulated over micro batches
+
     def trainD(self, netD, real_data, fake_data):
-        real_score = netD(real_data).mean()
-        fake_score = netD(fake_data.detach()).mean()
+        real_score = netD(real_data).float().mean()
+        fake_score = netD(fake_data.detach()).float().mean()
         WD = real_score - fake_score
         Dloss = -1 * WD  # Maximize term to get WD
 
-        debug_dict = {"W1": WD.item()} #, 'real_score': real_score.item() , "fake_score": fake_score.item()}
+        debug_dict = {"W1": WD.detach()} #, 'real_score': real_score.item() , "fake_score": fake_score.item()}
         return Dloss, debug_dict
 
+    def trainD_fused(self, netD, real_data, fake_data, scaler=None):
+        """Same as trainD but real, fake and gradient penalty interpolates go through netD in a single batch.
+        Returns the gradient penalty and gradient norm as well"""
+        real_score, fake_score, gp, gradient_norm = calc_fused_wgan_gp(netD, real_data, fake_data, scaler=scaler)
+        WD = real_score - fake_score
+        Dloss = -1 * WD  # Maximize term to get WD
+
+        debug_dict = {"W1": WD.detach()}
+        return Dloss, debug_dict, gp, gradient_norm
+
     def trainG(self, netD, real_data, fake_data):
-        Gloss = -1* netD(fake_data).mean() #  Minimize WD w.r.t netG (fake data)
-        return Gloss, {"Gloss": Gloss.item()}
+        Gloss = -1* netD(fake_data).float().mean() #  Minimize WD w.r.t netG (fake data)
+        return Gloss, {"Gloss": Gloss.detach()}
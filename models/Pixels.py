@@ -1,13 +1,25 @@
 import torch
 from torch import nn
+from torch.nn import functional as F
 
 from utils.common import hash_vectors
 
 
 class Generator(nn.Module):
-    def __init__(self, z_dim, output_dim, n=64, init_mode='noise', channels=3):
+    """
+    Directly optimized bank of n images.
+    With sparse=True the bank is stored as an (n, pixels) table read with a sparse-gradient embedding lookup so that
+    optimizers supporting sparse gradients (optim.SparseAdam) only update the rows of the images in the batch.
+    With half=True the bank is kept in bfloat16 (float32's range so Adam's moments and eps are safe, but updates smaller
+    than ~1/256 of a pixel value are rounded away: use a large enough lrG)
+    """
+    takes_indices = True  # A 'const' prior feeds the indices of the images to output
+
+    def __init__(self, z_dim, output_dim, n=64, init_mode='noise', channels=3, sparse='False', half='False'):
         super(Generator, self).__init__()
         self.n = int(n)
+        self.sparse = sparse == 'True'
+        self.image_shape = (channels, output_dim, output_dim)
         if init_mode == "noise":
             images = torch.randn(self.n, channels ,output_dim, output_dim) * 0.5
         elif init_mode == "ones":
@@ -16,21 +28,41 @@ class Generator(nn.Module):
             images = torch.ones(self.n, channels, output_dim, output_dim)
         else:
             raise ValueError("Bad init mode")
+        if self.sparse:
+            images = images.reshape(self.n, -1)
+        if half == 'True':
+            images = images.to(torch.bfloat16)
         self.images = nn.Parameter(images, requires_grad=True)
+        self._register_load_state_dict_pre_hook(self._reshape_loaded_images)
         # self.clip()
 
+    def _reshape_loaded_images(self, state_dict, prefix, *args):
+        """Checkpoints of sparse and dense banks are interchangeable (load_state_dict casts the dtype)"""
+        if prefix + 'images' in state_dict:
+            state_dict[prefix + 'images'] = state_dict[prefix + 'images'].reshape(self.images.shape)
+
     def forward(self, input):
-        b = input.shape[0]
-        if b != self.n:
-            outputs = self.images[hash_vectors(input.detach(), n=self.n)]
+        if input.is_floating_point():
+            # Latent vectors (e.g older scripts / priors) are mapped to images by hashing them
+            b = input.shape[0]
+            indices = hash_vectors(input.detach(), n=self.n) if b != self.n else None
+            if indices is None and self.sparse:
+                indices = torch.arange(self.n, device=input.device)  # Sparse banks only get sparse gradients
             # outputs = self.images[torch.randperm(self.n)[:b]]
         else:
+            indices = input
+
+        if indices is None:
             outputs = self.images
-        return torch.tanh(outputs)
+        elif self.sparse:
+            outputs = F.embedding(indices, self.images, sparse=True)
+        else:
+            outputs = self.images[indices]
+        return torch.tanh(outputs.float().reshape(-1, *self.image_shape))
 
 
 
 if __name__ == '__main__':
     netG = Generator(100, 64, n=1000)
     z = torch.randn((16,100))
-    print(netG(z).shape)
\ No newline at end of file
+    print(netG(z).shape)
@@ -0,0 +1,37 @@
+from copy import deepcopy
+
+import torch
+from torch import nn
+from torch.nn.utils import parametrize
+from torch.nn.utils.fusion import fuse_conv_bn_eval
+
+
+def fold_batch_norms(model):
+    """
+    Return an eval-mode copy of the model where every (transposed) convolution followed by a BatchNorm2d in the same
+    nn.Sequential (e.g a conv_block) is replaced by a single convolution with the normalization folded in
+    """
+    model = deepcopy(model).eval()
+    model.__dict__.pop('forward', None)  # Don't share a compiled forward with the original model
+    for module in model.modules():
+        if not isinstance(module, nn.Sequential):
+            continue
+        for i in range(len(module) - 1):
+            conv, bn = module[i], module[i + 1]
+            if isinstance(conv, (nn.Conv2d, nn.ConvTranspose2d)) and isinstance(bn, nn.BatchNorm2d) \
+                    and bn.track_running_stats and not parametrize.is_parametrized(conv):
+                module[i] = fuse_conv_bn_eval(conv, bn, transpose=isinstance(conv, nn.ConvTranspose2d))
+                module[i + 1] = nn.Identity()
+    return model
+
+
+def optimize_for_cpu_inference(model, example_input, memory_format=torch.channels_last):
+    """
+    Fold batch norms, trace and freeze the model for inference on 'example_input'-shaped inputs.
+    torch.jit.optimize_for_inference converts the frozen graph to oneDNN (MKLDNN) ops with fused conv+ReLU
+    """
+    model = fold_batch_norms(model).to(memory_format=memory_format)
+    with torch.no_grad():
+        traced = torch.jit.trace(model, example_input.contiguous(memory_format=memory_format)
+                                 if example_input.dim() == 4 else example_input)
+    return torch.jit.optimize_for_inference(torch.jit.freeze(traced))
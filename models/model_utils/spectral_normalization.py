@@ -1,12 +1,13 @@
 """
-Spectral normalization layers taken from https://github.com/godisboy/SN-GAN
+Spectral normalization following https://github.com/godisboy/SN-GAN implemented as a torch parametrization:
+the normalized weight can be computed once and reused by all the forwards of a step inside parametrize.cached()
 """
 
 import torch
 import torch.nn.functional as F
-from torch.nn.modules import Linear
-from torch.nn.modules import conv
-from torch.nn.modules.utils import _pair
+from torch import nn
+from torch.nn.utils import parametrize
+
 
 def _l2normalize(v, eps=1e-12):
     return v / (torch.norm(v) + eps)
@@ -20,7 +21,7 @@ def max_singular_value(W, u=None, Ip=1):
     if not Ip >= 1:
         raise ValueError("Power iteration should be a positive integer")
     if u is None:
-        u = torch.FloatTensor(1, W.size(0)).normal_(0, 1).cuda()
+        u = torch.randn(1, W.size(0), device=W.device, dtype=W.dtype)
     _u = u
     for _ in range(Ip):
         _v = _l2normalize(torch.matmul(_u, W.data), eps=1e-12)
@@ -29,76 +30,49 @@ def max_singular_value(W, u=None, Ip=1):
     return sigma, _u
 
 
-class SNLinear(Linear):
-    def __init__(self, in_features, out_features, bias=True):
-        super(SNLinear, self).__init__(in_features, out_features, bias)
-        self.register_buffer('u', torch.Tensor(1, out_features).normal_())
-
-    @property
-    def W_(self):
-        w_mat = self.weight.view(self.weight.size(0), -1)
-        sigma, _u = max_singular_value(w_mat, self.u)
-        self.u.copy_(_u)
-        return self.weight / sigma
-
-    def forward(self, input):
-        return F.linear(input, self.W_, self.bias)
-
-
-class SNConv2d(conv._ConvNd):
-    def __init__(self, in_channels, out_channels, kernel_size, stride=1, padding=0, dilation=1, groups=1, bias=True):
-        kernel_size = _pair(kernel_size)
-        stride = _pair(stride)
-        padding = _pair(padding)
-        dilation = _pair(dilation)
-        super(SNConv2d, self).__init__(
-            in_channels, out_channels, kernel_size, stride, padding, dilation,
-            False, _pair(0), groups, bias, padding_mode = 'zeros')
-        self.register_buffer('u', torch.Tensor(1, out_channels).normal_())
-
-    @property
-    def W_(self):
-        w_mat = self.weight.view(self.weight.size(0), -1)
+class SpectralNorm(nn.Module):
+    """
+    weight / sigma where sigma, the largest singular value of the weight, is estimated with a power iteration step from
+    the persistent vector u every time the weight is computed. As in SN-GAN sigma is not differentiated.
+    dim is the output dimension of the weight (1 for transposed convolutions)
+    """
+    def __init__(self, weight, dim=0):
+        super(SpectralNorm, self).__init__()
+        self.dim = dim
+        self.register_buffer('u', torch.randn(1, weight.size(dim), device=weight.device, dtype=weight.dtype))
+
+    def forward(self, weight):
+        w_mat = weight.transpose(0, self.dim) if self.dim != 0 else weight
+        w_mat = w_mat.reshape(w_mat.size(0), -1)
         sigma, _u = max_singular_value(w_mat, self.u)
-        self.u.copy_(_u)
-        return self.weight / sigma
-
-    def forward(self, input):
-        return F.conv2d(input, self.W_, self.bias, self.stride,
-                        self.padding, self.dilation, self.groups)
-
-
-def get_layer(model, name):
-    layer = model
-    for attr in name.split("."):
-        layer = getattr(layer, attr)
-    return layer
+        with torch.no_grad():
+            self.u.copy_(_u)
+        return weight / sigma
 
 
-def set_layer(model, name, layer):
-    try:
-        attrs, name = name.rsplit(".", 1)
-        model = get_layer(model, attrs)
-    except ValueError:
-        pass
-    setattr(model, name, layer)
+def _remap_legacy_keys(layer_names):
+    """Load checkpoints of the former SNLinear/SNConv2d layers ('<layer>.weight' and '<layer>.u')"""
+    def hook(state_dict, prefix, *args):
+        for name in layer_names:
+            old_weight, old_u = f"{prefix}{name}.weight", f"{prefix}{name}.u"
+            if old_weight in state_dict and old_u in state_dict:
+                state_dict[f"{prefix}{name}.parametrizations.weight.original"] = state_dict.pop(old_weight)
+                state_dict[f"{prefix}{name}.parametrizations.weight.0.u"] = state_dict.pop(old_u)
+    return hook
 
 
 def make_model_spectral_normalized(model):
-    for name, module in model.named_modules():
-        if isinstance(module, torch.nn.Linear):
-            new_conv = SNLinear(in_features=module.in_features, out_features=module.out_features, bias=module.bias is not None)
-        elif isinstance(module, torch.nn.Conv2d):
-            new_conv = SNConv2d(in_channels=module.in_channels,
-                                out_channels=module.out_channels,
-                                kernel_size=module.kernel_size,
-                                stride=module.stride,
-                                padding=module.padding,
-                                dilation=module.dilation,
-                                groups=module.groups,
-                                bias=not (module.bias is None))
+    """Spectrally normalize the weights of all Linear and (transposed) convolution layers of the model in place"""
+    layer_names = []
+    for name, module in list(model.named_modules()):
+        if isinstance(module, (nn.Linear, nn.Conv2d)):
+            dim = 0
+        elif isinstance(module, nn.ConvTranspose2d):
+            dim = 1
         else:
             continue
-        set_layer(model, name, new_conv)
+        parametrize.register_parametrization(module, "weight", SpectralNorm(module.weight, dim))
+        layer_names.append(name)
 
-    return model
\ No newline at end of file
+    model._register_load_state_dict_pre_hook(_remap_legacy_keys(layer_names))
+    return model
@@ -12,6 +12,7 @@ from utils.common import dump_images
 
 sys.path.append(os.path.join(os.path.dirname(__file__), ".."))
 from losses import get_loss_function
+from utils.feature_cache import FeatureCache
 
 COLORS =['r', 'g', 'b', 'k']
 
@@ -38,7 +39,7 @@ def main():
         for bs in args.batch_sizes:
 
             for name, batch in named_batches[bs].items():
-                dist = metric(batch, ref_data)
+                dist = metric(batch, ref_data, Y_id=ref_data_id)
                 print(metric_name, bs, name, dist.item())
                 distances[name].append(dist)
 
@@ -59,7 +60,7 @@ def plot(metric_name, distances, batch_sizes):
     plt.clf()
 
 
-if __name__ == '__main__':
+def parse_args(arguments=None):
     parser = argparse.ArgumentParser()
 
     # Data
@@ -70,7 +71,11 @@ if __name__ == '__main__':
     parser.add_argument('--gray_scale', action='store_true', default=False)
     parser.add_argument('--im_size', default=64, type=int)
     parser.add_argument('--batch_sizes', nargs='+', default=[10, 100, 500, 1000], type=int)
-    args = parser.parse_args()
+    return parser.parse_args(arguments)
+
+
+if __name__ == '__main__':
+    args = parse_args()
 
     output_dir = os.path.join(os.path.dirname(__file__), "..", "outputs", "batch_size_effect", os.path.basename(args.data_path))
     device = torch.device('cpu')
@@ -89,5 +94,10 @@ if __name__ == '__main__':
     ]
 
     metrics = {name: get_loss_function(name) for name in metric_names}
+    # Metrics on deep features extract those of the reference data once
+    feature_cache = FeatureCache()
+    for metric in metrics.values():
+        metric.cache = feature_cache
+    ref_data_id = (args.data_path, args.im_size, args.center_crop, args.gray_scale, args.limit_data, f"from-{max_bs}")
 
     main()
\ No newline at end of file
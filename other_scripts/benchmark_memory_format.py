@@ -0,0 +1,82 @@
+import argparse
+import importlib
+import os
+import sys
+from time import perf_counter
+
+import torch
+
+sys.path.append(os.path.join(os.path.dirname(__file__), ".."))
+from models.model_utils.fusion import optimize_for_cpu_inference
+from utils.common import parse_classnames_and_kwargs
+
+
+def build(arch, is_generator, args):
+    """Build a generator or discriminator from a train.py style architecture string (e.g 'PatchGAN-depth=4')"""
+    name, kwargs = parse_classnames_and_kwargs(arch, kwargs={"channels": 3})
+    module = importlib.import_module("models." + name)
+    if is_generator:
+        return module.Generator(z_dim=args.z_dim, output_dim=args.im_size, **kwargs)
+    return module.Discriminator(input_dim=args.im_size, **kwargs)
+
+
+def timeit(fn, n_iters, n_warmup=3):
+    for _ in range(n_warmup):
+        fn()
+    start = perf_counter()
+    for _ in range(n_iters):
+        fn()
+    return 1000 * (perf_counter() - start) / n_iters
+
+
+def benchmark(model, inputs, memory_format, n_iters):
+    """ms per training step (forward + backward) and per inference forward in the given memory format"""
+    model = model.to(memory_format=memory_format)
+    if inputs.dim() == 4:
+        inputs = inputs.contiguous(memory_format=memory_format)
+
+    def train_step():
+        model.zero_grad()
+        model(inputs).float().mean().backward()
+
+    def inference():
+        with torch.inference_mode():
+            model(inputs)
+
+    model.train()
+    train_ms = timeit(train_step, n_iters)
+    model.eval()
+    inference_ms = timeit(inference, n_iters)
+    return train_ms, inference_ms
+
+
+def main():
+    """Compare contiguous (NCHW) and channels_last training and inference speed of the convolutional architectures,
+    and inference through BN folded, oneDNN fused conv+ReLU frozen graphs"""
+    torch.set_num_threads(args.n_threads)
+    print(f"{'model':<40} {'format':<16} {'train(ms)':>10} {'inference(ms)':>14}")
+    for arch, is_generator in [(a, True) for a in args.gen_archs] + [(a, False) for a in args.disc_archs]:
+        model = build(arch, is_generator, args)
+        inputs = torch.randn(args.b, args.z_dim) if is_generator else torch.randn(args.b, 3, args.im_size, args.im_size)
+        name = f"{'G' if is_generator else 'D'}:{arch}"
+        for format_name, memory_format in [("contiguous", torch.contiguous_format), ("channels_last", torch.channels_last)]:
+            train_ms, inference_ms = benchmark(model, inputs, memory_format, args.n_iters)
+            print(f"{name:<40} {format_name:<16} {train_ms:>10.2f} {inference_ms:>14.2f}")
+
+        fused = optimize_for_cpu_inference(model, inputs)
+        fused_ms = timeit(lambda: fused(inputs.contiguous(memory_format=torch.channels_last) if inputs.dim() == 4 else inputs), args.n_iters)
+        print(f"{name:<40} {'fused-oneDNN':<16} {'-':>10} {fused_ms:>14.2f}")
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--gen_archs', nargs='+', default=['DCGAN', 'DCGAN-normalize=bn'])
+    parser.add_argument('--disc_archs', nargs='+', default=['DCGAN', 'DCGAN-normalize=bn', 'PatchGAN-depth=4'])
+    parser.add_argument('--im_size', default=64, type=int)
+    parser.add_argument('--z_dim', default=64, type=int)
+    parser.add_argument('--b', default=64, type=int)
+    parser.add_argument('--n_iters', default=20, type=int)
+    parser.add_argument('--n_threads', default=torch.get_num_threads(), type=int)
+    args = parser.parse_args()
+
+    main()
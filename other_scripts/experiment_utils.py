@@ -10,11 +10,15 @@ import torch.nn.functional as F
 
 import sys
 sys.path.append(os.path.join(os.path.dirname(__file__), ".."))
-from utils.data import get_transforms
+from utils.data import get_transforms, load_shared_data
 
 
 def get_data(data_path, im_size=None, center_crop=None, gray_scale=False, limit_data=None):
     if os.path.isdir(data_path):
+        shared_data = load_shared_data(data_path, im_size, center_crop, gray_scale, limit_data, mmap_mode='c')
+        if shared_data is not None:
+            return torch.from_numpy(shared_data)  # Copy-on-write: the pages stay shared with the other runs
+
         image_paths = sorted([os.path.join(data_path, x) for x in os.listdir(data_path)])[:limit_data]
     else:
         image_paths = [data_path]
@@ -11,28 +11,37 @@ from experiment_utils import get_data, find_last_file
 sys.path.append(os.path.join(os.path.dirname(__file__), ".."))
 from models import get_models
 from utils.train_utils import Prior
+from utils.checkpoint import load_checkpoint
+from utils.pairwise_distances import pairwise_distances
 
 
 def to_np(img):
     if img.shape[0] == 1:
         img = img.repeat(3,1,1)
-    img = img.add_(1).div(2).mul(255).clamp_(0, 255)
+    img = img.add(1).div(2).mul(255).clamp_(0, 255)
     if len(img.shape) == 3:
         img = img.permute(1, 2, 0)
     return img.to("cpu", torch.uint8).cpu().numpy()
 
 
-def find_nns(fake_images, data, outputs_dir,s=4):
+def find_nns(fake_batches, data, outputs_dir,s=4):
+    """param fake_batches: iterable of batches of generated images whose nearest neighbors are computed batch by batch"""
     os.makedirs(f'{outputs_dir}', exist_ok=True)
-    n = len(fake_images)
     with torch.no_grad():
+        fake_images, nn_dists, nn_indices = [], [], []
+        for fakes in fake_batches:
+            dists_mat = pairwise_distances(fakes.reshape(len(fakes), -1), data.reshape(len(data), -1), squared=True)
+            batch_dists, batch_indices = dists_mat.min(1)
+            fake_images.append(fakes)
+            nn_dists.append(batch_dists)
+            nn_indices.append(batch_indices)
+        fake_images, nn_dists, nn_indices = torch.cat(fake_images), torch.cat(nn_dists), torch.cat(nn_indices)
+        n = len(fake_images)
         fig, axes = plt.subplots(2, n, figsize=(s * n, s * 2))
 
         for i in range(len(fake_images)):
             fake_image = fake_images[i]
-            # dists = dists_mat[i]
-            dists = [(fake_image - data[j]).pow(2).sum().item() for j in range(len(data))]
-            nn_index = np.argsort(dists)[0]
+            nn_index = nn_indices[i].item()
             nn = data[nn_index]
             axes[0, i].imshow(to_np(fake_image))
             axes[0, i].axis('off')
@@ -40,7 +49,7 @@ def find_nns(fake_images, data, outputs_dir,s=4):
             axes[1, i].imshow(to_np(nn))
             axes[1, i].axis('off')
             axes[1, i].set_ylabel('Nearest neighbor')
-            axes[1, i].set_title(f"NN L2: {dists[nn_index]:.3f}")
+            axes[1, i].set_title(f"NN L2: {nn_dists[i].item():.3f}")
     plt.tight_layout()
     plt.savefig(os.path.join(outputs_dir, f"NNs.png"))
 
@@ -48,15 +57,16 @@ def find_nns(fake_images, data, outputs_dir,s=4):
 def load_pretrained_models(args, ckpt_path, device):
     netG, netD = get_models(args, device)
 
-    weights = torch.load(ckpt_path, map_location=device)
+    weights = load_checkpoint(ckpt_path, map_location=device)
     netG.load_state_dict(weights['netG'])
     netG.to(device)
     netG.eval()
 
-    netD.load_state_dict(weights['netD'])
+    if 'netD' in weights:  # Checkpoints of ensemble members only have a generator
+        netD.load_state_dict(weights['netD'])
     netD.to(device)
     netD.eval()
-    prior = Prior(args.z_prior, args.z_dim)
+    prior = Prior(args.z_prior, args.z_dim, use_indices=getattr(netG, 'takes_indices', False))
     prior.z = weights['prior']
 
     return netG, netD, prior
@@ -89,5 +99,5 @@ if __name__ == '__main__':
     # Full data tests
     data = get_data(args['data_path'], args['im_size'], args['center_crop'], args['gray_scale'], limit_data=args['limit_data'])
 
-    fake_images = netG(prior.sample(script_args.n_samples).to(device))
-    find_nns(fake_images, data, outputs_dir=outputs_dir)
+    fake_batches = (netG(z.to(device)) for z in torch.split(prior.sample(script_args.n_samples), 64))
+    find_nns(fake_batches, data, outputs_dir=outputs_dir)
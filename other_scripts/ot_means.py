@@ -10,6 +10,7 @@ from experiment_utils import get_data
 
 sys.path.append(os.path.join(os.path.dirname(__file__), ".."))
 from utils.common import dump_images
+from utils.pairwise_distances import pairwise_distances
 
 
 def get_ot_plan(C):
@@ -21,7 +22,9 @@ def get_ot_plan(C):
 
 
 def dist_mat(X, Y):
-    return ((X * X).sum(1)[:, None] + (Y * Y).sum(1)[None, :] - 2.0 * X @ Y.T)**0.5
+    """Squared distances are clamped to 1e-10 before the sqrt: rounding can make them slightly negative (NaNs in the
+    OT plan) when a centroid coincides with a data point"""
+    return pairwise_distances(X, Y, p=2)
 
 
 def weisfeld_step(X, dist_mat, W):
@@ -62,7 +65,8 @@ def ot_means(data, k, n_iters, init_from=None, debug_dir=None):
 
     return centroids
 
-if __name__ == "__main__":
+
+def parse_args(arguments=None):
     parser = argparse.ArgumentParser()
 
     # Data
@@ -81,7 +85,11 @@ if __name__ == "__main__":
     parser.add_argument('--project_name', default="OTMeans", type=str)
     parser.add_argument('--n_workers', default=4, type=int)
     parser.add_argument("--train_name", default=None, type=str)
-    args = parser.parse_args()
+    return parser.parse_args(arguments)
+
+
+if __name__ == "__main__":
+    args = parse_args()
 
     if args.train_name is None:
         args.train_name = f"{os.path.basename(args.data_path)}_I-{args.im_size}_K-{args.k}"
@@ -0,0 +1,102 @@
+import argparse
+import itertools
+import json
+import os
+import random
+import shlex
+import subprocess
+import sys
+from concurrent.futures import ThreadPoolExecutor
+
+sys.path.append(os.path.join(os.path.dirname(__file__), ".."))
+from utils.train_utils import parse_train_args
+from sweep import collect_metrics, write_results
+
+ROOT = os.path.abspath(os.path.join(os.path.dirname(__file__), ".."))
+
+
+def sample_configs(search_space, n_configs, seed):
+    """All the configurations of the grid 'search_space' ({flag: [values]}) or n_configs random ones out of it"""
+    names = list(search_space)
+    grid = [dict(zip(names, values)) for values in itertools.product(*(search_space[name] for name in names))]
+    if n_configs is not None and n_configs < len(grid):
+        grid = random.Random(seed).sample(grid, n_configs)
+    return grid
+
+
+def train(run, n_iterations, log_dir):
+    """Train (or resume) the run up to n_iterations and return the return code of train.py"""
+    command = [sys.executable, "train.py"] + run["args"] + ["--n_iterations", str(n_iterations), "--resume_last_ckpt"]
+    with open(os.path.join(log_dir, f"{run['name']}.log"), 'a') as log_file:
+        return subprocess.run(command, cwd=ROOT, stdout=log_file, stderr=subprocess.STDOUT).returncode
+
+
+def main():
+    """
+    Successive halving: train every configuration for --min_iterations, keep the 1/eta fraction with the best (lowest)
+    logged metric and resume the survivors from their last checkpoint for eta times more iterations, until
+    --max_iterations or a single configuration is left
+    """
+    base_args = shlex.split(args.base_args)
+    search_space = json.load(open(args.search_space))
+    search_name = os.path.splitext(os.path.basename(args.search_space))[0]
+    search_dir = os.path.join(ROOT, "outputs", "searches", search_name)
+    log_dir = os.path.join(search_dir, "logs")
+    os.makedirs(log_dir, exist_ok=True)
+    project_name = parse_train_args(base_args).project_name
+
+    runs = []
+    for i, config in enumerate(sample_configs(search_space, args.n_configs, args.seed)):
+        name = f"{search_name}-{i}"
+        config_args = [token for flag, value in config.items() for token in (f"--{flag}", str(value))]
+        runs.append({"name": name, "config": config,
+                     "args": base_args + config_args + ["--train_name", name, "--log_freq", str(args.log_freq)],
+                     "output_dir": os.path.join(ROOT, "outputs", project_name, name)})
+
+    rows = []
+    survivors = runs
+    n_iterations = args.min_iterations
+    rung = 0
+    while True:
+        print(f"Rung {rung}: training {len(survivors)} configurations up to {n_iterations} iterations")
+        with ThreadPoolExecutor(max_workers=args.n_parallel) as pool:
+            returncodes = list(pool.map(lambda run: train(run, n_iterations, log_dir), survivors))
+
+        for run, returncode in zip(survivors, returncodes):
+            run["metric"] = collect_metrics(run).get(args.metric) if returncode == 0 else None
+            rows.append({"rung": rung, "iterations": n_iterations, "name": run["name"], "returncode": returncode,
+                         args.metric: run["metric"], **run["config"]})
+            print(f"\t{run['name']} {run['config']}: {run['metric']}")
+        write_results(rows, os.path.join(search_dir, "results.csv"))
+
+        finished = [run for run in survivors if run["metric"] is not None]
+        finished.sort(key=lambda run: run["metric"])
+        next_iterations = n_iterations * args.eta
+        if len(finished) <= 1 or next_iterations > args.max_iterations:
+            break
+        survivors = finished[:max(1, len(finished) // args.eta)]
+        n_iterations = next_iterations
+        rung += 1
+
+    if finished:
+        print(f"Best configuration: {finished[0]['config']} ({args.metric}: {finished[0]['metric']}) "
+              f"in {finished[0]['output_dir']}")
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser()
+    parser.add_argument('search_space', help="json file mapping train.py flags to lists of values, e.g "
+                                             "{\"lrG\": [0.0001, 0.001], \"gp_weight\": [1, 10]}")
+    parser.add_argument('--base_args', required=True, help="train.py arguments shared by all configurations")
+    parser.add_argument('--metric', default="MiniBatchLoss-dist=swd_fixed_noise_gen_to_train",
+                        help="Logged metric to minimize")
+    parser.add_argument('--n_configs', default=None, type=int, help="Number of random configurations (default: all)")
+    parser.add_argument('--min_iterations', default=1000, type=int)
+    parser.add_argument('--max_iterations', default=100000, type=int)
+    parser.add_argument('--eta', default=3, type=int, help="Keep 1/eta of the configurations and train eta times longer")
+    parser.add_argument('--log_freq', default=500, type=int, help="Evaluation and checkpoint frequency of the runs")
+    parser.add_argument('--n_parallel', default=1, type=int, help="Number of configurations trained in parallel")
+    parser.add_argument('--seed', default=0, type=int)
+    args = parser.parse_args()
+
+    main()
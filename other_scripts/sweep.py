@@ -0,0 +1,154 @@
+import argparse
+import csv
+import importlib
+import json
+import os
+import shlex
+import shutil
+import subprocess
+import sys
+import time
+
+sys.path.append(os.path.join(os.path.dirname(__file__), ".."))
+from utils.data import store_shared_data
+from utils.train_utils import parse_train_args
+
+ROOT = os.path.abspath(os.path.join(os.path.dirname(__file__), ".."))
+
+
+def parse_sweep_file(path):
+    """One command per line as in the README (e.g 'python3 train.py --data_path ...'). '#' starts a comment"""
+    runs = []
+    with open(path) as f:
+        for line in f:
+            line = line.split("#")[0].strip()
+            if not line:
+                continue
+            tokens = shlex.split(line)
+            if os.path.basename(tokens[0]).startswith("python"):
+                tokens = tokens[1:]
+            runs.append({"script": tokens[0], "args": tokens[1:]})
+    return runs
+
+
+def data_variant(run):
+    """The (data_path, im_size, center_crop, gray_scale, limit_data) a run loads"""
+    script = os.path.basename(run["script"])
+    if script == "train.py":
+        data_args = vars(parse_train_args(run["args"]))
+    else:  # Parsed by the script's own parser so that its defaults are used
+        data_args = vars(importlib.import_module(os.path.splitext(script)[0]).parse_args(run["args"]))
+    return tuple(data_args[k] for k in ("data_path", "im_size", "center_crop", "gray_scale", "limit_data"))
+
+
+def prepare_run(run, i, sweep_name):
+    """Name train.py runs after the sweep (unless named) and limit their data loading to the main process"""
+    script = os.path.basename(run["script"])
+    if script == "train.py":
+        train_args = parse_train_args(run["args"])
+        if train_args.train_name is None:
+            run["args"] += ["--train_name", f"{sweep_name}-{i}"]
+            train_args.train_name = f"{sweep_name}-{i}"
+        if "--n_workers" not in run["args"]:
+            run["args"] += ["--n_workers", "0"]  # Batches are read from shared memory
+        run["output_dir"] = os.path.join(ROOT, "outputs", train_args.project_name, train_args.train_name)
+    elif script == "batch_size_effect.py":
+        run["output_dir"] = os.path.join(ROOT, "outputs", "batch_size_effect", os.path.basename(data_variant(run)[0]))
+    else:
+        run["output_dir"] = None
+
+
+def collect_metrics(run):
+    """The last logged value of every metric of a train.py run"""
+    history_path = os.path.join(run["output_dir"] or "", "plots", "history.jsonl")
+    metrics = dict()
+    if os.path.exists(history_path):
+        with open(history_path) as f:
+            for line in f:
+                for k, (avg, std, last_value) in json.loads(line)["values"].items():
+                    metrics[k] = last_value
+    return metrics
+
+
+def write_results(rows, path):
+    fieldnames = []
+    for row in rows:
+        fieldnames += [k for k in row if k not in fieldnames]
+    with open(path, 'w', newline='') as f:
+        writer = csv.DictWriter(f, fieldnames=fieldnames)
+        writer.writeheader()
+        writer.writerows(rows)
+
+
+def main():
+    """
+    Run all the commands of a sweep file. Every dataset variant is decoded once into a shared data file (in /dev/shm by
+    default) that the runs memory-map, and runs are launched in parallel as long as their threads fit in --n_cpus and
+    their memory (+ the shared data) in --memory_gb. Metrics and outputs of all runs are written to results.csv
+    """
+    runs = parse_sweep_file(args.sweep_file)
+    sweep_name = os.path.splitext(os.path.basename(args.sweep_file))[0]
+    sweep_dir = os.path.join(ROOT, "outputs", "sweeps", sweep_name)
+    logs_dir = os.path.join(sweep_dir, "logs")
+    os.makedirs(logs_dir, exist_ok=True)
+    shared_dir = os.path.join(args.shared_dir, f"sweep-{sweep_name}")
+    os.makedirs(shared_dir, exist_ok=True)
+
+    shared_bytes = 0
+    for variant in sorted(set(data_variant(run) for run in runs), key=str):
+        print(f"Loading data variant {variant} into shared memory")
+        shared_bytes += store_shared_data(*variant, shared_dir=shared_dir)
+    memory_budget = args.memory_gb - shared_bytes / 1024**3
+    n_parallel = max(1, min(args.n_cpus // args.threads_per_run, int(memory_budget // args.memory_per_run_gb)))
+    print(f"Running {len(runs)} runs, {n_parallel} at a time")
+
+    env = dict(os.environ, SHARED_DATA_DIR=shared_dir, OMP_NUM_THREADS=str(args.threads_per_run),
+               MKL_NUM_THREADS=str(args.threads_per_run))
+    pending = list(enumerate(runs))
+    running = dict()
+    rows = []
+    try:
+        while pending or running:
+            while pending and len(running) < n_parallel:
+                i, run = pending.pop(0)
+                prepare_run(run, i, sweep_name)
+                log_file = open(os.path.join(logs_dir, f"{i}.log"), 'w')
+                process = subprocess.Popen([sys.executable, run["script"]] + run["args"], cwd=ROOT, env=env,
+                                           stdout=log_file, stderr=subprocess.STDOUT)
+                running[i] = (process, log_file, time.time())
+
+            time.sleep(1)
+            for i, (process, log_file, start) in list(running.items()):
+                if process.poll() is None:
+                    continue
+                log_file.close()
+                del running[i]
+                run = runs[i]
+                row = {"run": i, "command": shlex.join([run["script"]] + run["args"]), "returncode": process.returncode,
+                       "seconds": round(time.time() - start, 1), "output_dir": run["output_dir"],
+                       "log": log_file.name}
+                row.update(collect_metrics(run))
+                rows.append(row)
+                print(f"Run {i} finished with code {process.returncode} in {row['seconds']} seconds")
+                write_results(sorted(rows, key=lambda r: r["run"]), os.path.join(sweep_dir, "results.csv"))
+    finally:
+        for process, log_file, _ in running.values():
+            process.terminate()
+        if not args.keep_shared_data:
+            shutil.rmtree(shared_dir, ignore_errors=True)
+    print(f"Results written to {os.path.join(sweep_dir, 'results.csv')}")
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser()
+    parser.add_argument('sweep_file', help="Text file with one train.py / ot_means.py / batch_size_effect.py command per line")
+    parser.add_argument('--n_cpus', default=os.cpu_count(), type=int, help="CPU threads budget of all parallel runs")
+    parser.add_argument('--threads_per_run', default=4, type=int)
+    parser.add_argument('--memory_gb', default=32, type=float, help="Memory budget of all parallel runs and shared data")
+    parser.add_argument('--memory_per_run_gb', default=4, type=float)
+    parser.add_argument('--shared_dir', default="/dev/shm", help="Where to store the decoded datasets")
+    parser.add_argument('--keep_shared_data', action='store_true', default=False,
+                        help="Keep the decoded datasets for following sweeps")
+    args = parser.parse_args()
+
+    main()
@@ -0,0 +1,28 @@
+import os
+import subprocess
+import sys
+
+import numpy as np
+import pytest
+from PIL import Image
+
+TRAIN_SCRIPT = os.path.join(os.path.dirname(__file__), "..", "train.py")
+
+
+@pytest.fixture
+def image_dir(tmp_path):
+    """A folder of 24 random 16x16 images"""
+    data_dir = tmp_path / "data"
+    os.makedirs(data_dir)
+    rng = np.random.RandomState(0)
+    for i in range(24):
+        Image.fromarray(rng.randint(0, 256, (16, 16, 3), dtype=np.uint8)).save(data_dir / f"{i:03d}.png")
+    return str(data_dir)
+
+
+def run_train(cwd, *args, **run_kwargs):
+    """Run train.py on the 'data' folder of cwd with small models on CPU"""
+    command = [sys.executable, TRAIN_SCRIPT, "--data_path", "data", "--im_size", "16", "--gen_arch", "FC",
+               "--r_bs", "4", "--f_bs", "4", "--z_prior", "const=16", "--device", "cpu", *args]
+    # A hang fails the test
+    subprocess.run(command, cwd=cwd, check=True, timeout=300, stdout=subprocess.DEVNULL, **run_kwargs)
@@ -0,0 +1,15 @@
+import os
+
+import torch
+
+from conftest import run_train
+
+
+def test_loss_scale_is_updated_once_per_iteration(tmp_path, image_dir):
+    """D and G both step every iteration but share a single GradScaler update"""
+    run_train(tmp_path, "--disc_arch", "FC", "--loss_function", "WGANLoss", "--amp", "fp16", "--n_workers", "0",
+              "--log_freq", "2", "--save_every", "--n_iterations", "4", "--train_name", "amp")
+    ckpt = torch.load(os.path.join(tmp_path, "outputs", "train_results", "amp", "models", "3.pth"), weights_only=False)
+    # Successful updates since the last skipped step: at most one per iteration (updating after each optimizer step
+    # counted two)
+    assert 0 < ckpt['scaler']['_growth_tracker'] <= 4
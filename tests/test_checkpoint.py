@@ -0,0 +1,39 @@
+import os
+import random
+
+import numpy as np
+import pytest
+import torch
+
+from utils.checkpoint import CheckpointWriter, load_checkpoint
+
+
+def test_keeps_the_latest_iterations(tmp_path):
+    """Old checkpoints are removed by iteration (not by write time) and files of other writers are kept"""
+    torch.save({}, tmp_path / "last.pth")
+    torch.save({}, tmp_path / "pretrained.pth")
+    writer = CheckpointWriter(str(tmp_path), keep_last=2)
+    for iteration in [10, 2, 30, 4]:  # e.g 10 and 30 left by a previous run in the folder
+        writer.save({"iteration": iteration}, f"{tmp_path}/{iteration}.pth")
+    writer.close()
+    assert sorted(os.listdir(tmp_path)) == ["10.pth", "30.pth", "last.pth", "pretrained.pth"]
+
+
+def test_loads_checkpoints_refused_by_weights_only(tmp_path):
+    path = str(tmp_path / "legacy.pth")
+    torch.save({"numpy": np.random.get_state(), "python": random.getstate(), "w": torch.ones(2)}, path)
+    with pytest.warns(UserWarning, match="weights_only"):
+        assert torch.equal(load_checkpoint(path)["w"], torch.ones(2))
+
+
+def test_corrupt_checkpoints_are_not_unpickled(tmp_path, monkeypatch):
+    path = str(tmp_path / "corrupt.pth")
+    torch.save({"w": torch.ones(1000)}, path)
+    with open(path, 'r+b') as f:
+        f.truncate(os.path.getsize(path) // 2)
+    loads = []
+    original_load = torch.load
+    monkeypatch.setattr(torch, "load", lambda *args, **kwargs: loads.append(kwargs) or original_load(*args, **kwargs))
+    with pytest.raises(RuntimeError):
+        load_checkpoint(path)
+    assert all(kwargs.get('weights_only', True) for kwargs in loads)
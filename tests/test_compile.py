@@ -0,0 +1,57 @@
+from copy import deepcopy
+
+import pytest
+import torch
+from torch._dynamo.backends.common import aot_autograd
+
+from conftest import run_train
+from losses import get_loss_function
+from utils.train_utils import calc_gradient_penalty, compile_models, compile_with_fallback
+
+
+def broken_compiler(gm, example_inputs):
+    raise RuntimeError("broken compiler")
+
+
+def test_falls_back_on_backward_compilation_failure(capsys):
+    """A failing backward compiler is caught in the forward call, not raised later by backward()"""
+    torch._dynamo.reset()
+    net = torch.nn.Linear(4, 2)
+    forward = compile_with_fallback(net.forward, "net",
+                                    backend=aot_autograd(fw_compiler=lambda gm, _: gm, bw_compiler=broken_compiler))
+    x = torch.randn(3, 4)
+    out = forward(x)
+    out.sum().backward()
+    assert "falling back" in capsys.readouterr().out
+    assert torch.allclose(out, net(x))
+    assert net.weight.grad is not None
+
+
+def test_model_errors_are_raised(capsys):
+    """A wrong input shape is a bug of the caller and must not be hidden by a silent fallback to eager"""
+    torch._dynamo.reset()
+    net = torch.nn.Linear(4, 2)
+    forward = compile_with_fallback(net.forward, "net", backend="eager")
+    with pytest.raises(RuntimeError):
+        forward(torch.randn(3, 5))
+    assert "falling back" not in capsys.readouterr().out
+
+
+def test_gradient_penalty_through_compiled_models():
+    """The double backward of the gradient penalty isn't supported by compiled graphs: netD stays in eager mode"""
+    torch._dynamo.reset()
+    netG = torch.nn.Sequential(torch.nn.Linear(4, 8), torch.nn.Tanh())
+    netD = torch.nn.Sequential(torch.nn.Linear(8, 16), torch.nn.LeakyReLU(0.2), torch.nn.Linear(16, 1))
+    eager_netD = deepcopy(netD)
+    compile_models(netG, netD, get_loss_function("WGANLoss"), gp_weight=10)
+    real, fake = torch.randn(4, 8), netG(torch.randn(4, 4))
+    for net in [netD, eager_netD]:
+        torch.manual_seed(0)
+        gp, _ = calc_gradient_penalty(net, real, fake)
+        gp.backward()
+    assert torch.allclose(netD[0].weight.grad, eager_netD[0].weight.grad)
+
+
+def test_compiled_wgan_gp_training(tmp_path, image_dir):
+    run_train(tmp_path, "--disc_arch", "FC", "--loss_function", "WGANLoss", "--gp_weight", "10", "--compile",
+              "--n_workers", "0", "--n_iterations", "3", "--log_freq", "2", "--train_name", "compiled")
@@ -0,0 +1,47 @@
+import time
+
+import pytest
+import torch
+
+from utils.data import BatchStream, get_dataset
+
+
+@pytest.mark.parametrize("n_workers", [0, 2])
+def test_stream_matches_get_batch(image_dir, n_workers):
+    """Batches from the (worker) stream follow the sampler order, also while the main thread runs torch ops"""
+    dataset = get_dataset(image_dir, 16)
+    stream = BatchStream(dataset, 4, n_workers, torch.device('cpu'), seed=1, start_batch=3)
+    try:
+        reference = [stream.get_batch(k) for k in range(3, 13)]
+        torch.nn.Conv2d(3, 8, 3)(torch.randn(16, 3, 32, 32)).sum()
+        for expected in reference:
+            assert torch.equal(next(stream), expected)
+        assert stream.consumed == 13
+    finally:
+        stream.close()
+
+
+class FailingDataset(torch.utils.data.Dataset):
+    """Fails on its second read"""
+    def __init__(self):
+        self.reads = 0
+
+    def __len__(self):
+        return 16
+
+    def __getitem__(self, idx):
+        self.reads += 1
+        if self.reads == 2:
+            raise ValueError("corrupt image")
+        return torch.zeros(3, 4, 4)
+
+
+def test_stream_raises_loader_errors_when_queue_is_full():
+    stream = BatchStream(FailingDataset(), 1, 0, torch.device('cpu'), prefetch=1)
+    try:
+        time.sleep(0.5)  # The first batch fills the queue before the second one fails
+        next(stream)
+        with pytest.raises(ValueError):
+            next(stream)
+    finally:
+        stream.close()
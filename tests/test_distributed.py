@@ -0,0 +1,76 @@
+import os
+from copy import deepcopy
+
+import torch
+import torch.distributed as dist
+import torch.multiprocessing as mp
+from torch.nn.parallel import DistributedDataParallel
+
+from losses import get_loss_function
+from models.FC import Discriminator
+from utils.distributed import GlobalBatchLoss
+from utils.train_utils import calc_gradient_penalty
+
+WORLD_SIZE = 2
+
+
+def run_ranks(fn, tmp_path):
+    mp.spawn(init_and_run, args=(fn, str(tmp_path / "rendezvous")), nprocs=WORLD_SIZE, join=True)
+
+
+def init_and_run(rank, fn, rendezvous_file):
+    dist.init_process_group("gloo", init_method=f"file://{rendezvous_file}", rank=rank, world_size=WORLD_SIZE)
+    try:
+        fn(rank)
+    finally:
+        dist.destroy_process_group()
+
+
+def same_on_all_ranks(x):
+    gathered = [torch.zeros_like(x) for _ in range(WORLD_SIZE)]
+    dist.all_gather(gathered, x)
+    return all(torch.equal(g, gathered[0]) for g in gathered)
+
+
+def global_swd_rank(rank):
+    torch.manual_seed(100 + rank)  # Ranks have their own noise, as in train.py
+    loss_function = GlobalBatchLoss(get_loss_function("MiniBatchPatchLoss-dist=swd-p=4-s=2-n_samples=64"), seed=7)
+    noise_state = torch.get_rng_state()
+    for _ in range(2):
+        real = torch.rand(4, 3, 8, 8) + rank
+        fake = torch.rand(4, 3, 8, 8, requires_grad=True)
+        loss, _ = loss_function.trainG(None, real, fake)
+        assert same_on_all_ranks(loss.detach())  # Same projections and sampled patches on all ranks
+    assert not same_on_all_ranks(torch.get_rng_state().float())  # Noise sampling still differs between ranks
+    assert not torch.equal(noise_state, torch.get_rng_state())
+
+
+def test_global_batch_loss_randomness_is_shared(tmp_path):
+    run_ranks(global_swd_rank, tmp_path)
+
+
+def ddp_gradient_penalty_rank(rank):
+    torch.manual_seed(0)
+    netD = Discriminator(input_dim=8, nf=16, depth=3)
+    reference = deepcopy(netD)
+    ddp_netD = DistributedDataParallel(netD)
+    real, fake = torch.randn(4, 3, 8, 8) + rank, torch.randn(4, 3, 8, 8)
+    loss_function = get_loss_function("WGANLoss")
+
+    def D_loss(model):
+        torch.manual_seed(rank)  # Same interpolation weight for the DDP and the reference forwards
+        Dloss, _ = loss_function.trainD(model, real, fake)
+        gp, _ = calc_gradient_penalty(model, real, fake)
+        return Dloss + 10 * gp
+
+    D_loss(ddp_netD).backward()
+    D_loss(reference).backward()
+    for p, p_reference in zip(netD.parameters(), reference.parameters()):
+        expected = p_reference.grad.clone()
+        dist.all_reduce(expected)
+        assert torch.allclose(p.grad, expected / WORLD_SIZE, atol=1e-6)
+        assert same_on_all_ranks(p.grad)
+
+
+def test_ddp_gradient_penalty_double_backward(tmp_path):
+    run_ranks(ddp_gradient_penalty_rank, tmp_path)
@@ -0,0 +1,63 @@
+import time
+
+import torch
+
+from utils.eval_worker import EvaluationWorker
+from utils.train_utils import Prior
+
+
+def log_mean(netG, iteration, logger, prior):
+    with torch.no_grad():
+        logger.log({"mean": netG(prior.sample(4)).mean()}, step=iteration)
+
+
+def slow_log_mean(netG, iteration, logger, prior):
+    time.sleep(2)
+    log_mean(netG, iteration, logger, prior)
+
+
+def crash(netG, iteration, logger, prior):
+    raise RuntimeError("evaluation crashed")
+
+
+class CollectingLogger:
+    def __init__(self):
+        self.logs = []
+
+    def log(self, data_dict, step):
+        self.logs.append((step, data_dict))
+
+
+def test_worker_evaluates_snapshots():
+    prior = Prior("const=4", 8)
+    prior.sample(4)
+    worker = EvaluationWorker(log_mean, torch.nn.Linear(8, 2), prior=prior)
+    worker.submit(torch.nn.Linear(8, 2), iteration=3)
+    logger = CollectingLogger()
+    worker.close(logger)
+    assert [step for step, _ in logger.logs] == [3]
+
+
+def test_final_state_is_always_evaluated():
+    """Intermediate evaluations are skipped while the worker is busy but the final one waits for it"""
+    prior = Prior("const=4", 8)
+    prior.sample(4)
+    worker = EvaluationWorker(slow_log_mean, torch.nn.Linear(8, 2), prior=prior)
+    for iteration in range(3):
+        worker.submit(torch.nn.Linear(8, 2), iteration=iteration)
+    worker.submit(torch.nn.Linear(8, 2), iteration=3, wait=True)
+    logger = CollectingLogger()
+    worker.close(logger)
+    steps = [step for step, _ in logger.logs]
+    assert steps[-1] == 3 and len(steps) < 4
+
+
+def test_close_returns_when_worker_died():
+    worker = EvaluationWorker(crash, torch.nn.Linear(8, 2), prior=Prior("normal", 8))
+    worker.submit(torch.nn.Linear(8, 2), iteration=0)
+    worker.process.join(60)
+    assert not worker.process.is_alive()
+    worker.submit(torch.nn.Linear(8, 2), iteration=1)  # Fills the jobs queue nobody reads anymore
+    start = time.time()
+    worker.close(CollectingLogger(), timeout=5)
+    assert time.time() - start < 30
@@ -0,0 +1,46 @@
+import torch
+
+from losses import get_loss_function
+from utils.feature_cache import FeatureCache
+
+
+def test_features_are_extracted_once_per_name_and_dataset(tmp_path):
+    calls = []
+
+    def extract():
+        calls.append(1)
+        return torch.ones(2, 3)
+
+    cache = FeatureCache(str(tmp_path))
+    cache.get("vgg-4", ("data", 64), extract)
+    cache.get("vgg-4", ("data", 64), extract)
+    assert len(calls) == 1
+    cache.get("vgg-9", ("data", 64), extract)  # Other extractor
+    cache.get("vgg-4", ("data", 32), extract)  # Other images
+    assert len(calls) == 3
+    FeatureCache(str(tmp_path)).get("vgg-4", ("data", 64), extract)  # Read from disk
+    assert len(calls) == 3
+
+
+class FakeVGG:
+    """Stands in for the pretrained VGG and counts the images it extracts features of"""
+    def __init__(self):
+        self.n_extracted = 0
+        self.normalize = lambda x: x
+
+    def extract_layers(self, x, layers, b=None, grad=False):
+        self.n_extracted += len(x)
+        return {l: x[:, :, ::2, ::2] * l for l in layers}
+
+
+def test_vgg_loss_caches_reference_features(tmp_path):
+    loss = get_loss_function("MiniBatchVGGLoss-dist=swd-layers=[4,9]")
+    loss.vgg = FakeVGG()
+    loss.cache = FeatureCache(str(tmp_path))
+    reals, fakes = torch.rand(8, 3, 8, 8), torch.rand(4, 3, 8, 8)
+    torch.manual_seed(0)
+    uncached = loss(fakes, reals)
+    for _ in range(3):
+        torch.manual_seed(0)
+        assert torch.allclose(loss.from_batches([fakes[:2], fakes[2:]], reals, Y_id="reals"), uncached)
+    assert loss.vgg.n_extracted == len(fakes) + len(reals) + 3 * len(fakes) + len(reals)
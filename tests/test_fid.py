@@ -0,0 +1,50 @@
+import os
+
+import pytest
+import torch
+from torchvision.models import inception_v3
+
+from benchmarking.fid import FIDEvaluator, RunningStatistics, kernel_inception_distance
+from benchmarking.inception import myInceptionV3
+
+
+@pytest.fixture(scope="module")
+def weights_path(tmp_path_factory):
+    torch.manual_seed(0)
+    path = tmp_path_factory.mktemp("weights") / "inception_v3.pth"
+    torch.save(inception_v3(weights=None, aux_logits=True, init_weights=True).state_dict(), path)
+    return str(path)
+
+
+def test_inception_matches_torchvision_input_transform(weights_path):
+    """Images in [-1, 1] give the features torchvision's IMAGENET1K_V1 setup (transform_input=True) gives"""
+    model = myInceptionV3(weights_path)
+    reference = inception_v3(weights=None, aux_logits=False, init_weights=False, transform_input=True)
+    reference.load_state_dict(model.model.state_dict(), strict=False)
+    reference.fc = torch.nn.Identity()
+    reference.eval()
+
+    images = torch.rand(2, 3, 299, 299) * 2 - 1
+    mean = torch.tensor([0.485, 0.456, 0.406]).view(1, 3, 1, 1)
+    std = torch.tensor([0.229, 0.224, 0.225]).view(1, 3, 1, 1)
+    with torch.no_grad():
+        features, expected = model(images), reference(((images + 1) / 2 - mean) / std)
+    assert (features - expected).abs().max() <= 1e-5 * expected.abs().max()  # Randomly initialized features are huge
+
+
+def test_kid_needs_two_samples():
+    x, y = RunningStatistics(), RunningStatistics()
+    x.update(torch.randn(1, 8))
+    y.update(torch.randn(4, 8))
+    with pytest.raises(ValueError):
+        kernel_inception_distance(x, y)
+
+
+def test_reference_cache_depends_on_weights(weights_path, tmp_path):
+    other_weights_path = str(tmp_path / "other_inception_v3.pth")
+    os.link(weights_path, other_weights_path)
+    cache_dir = str(tmp_path / "fid_stats")
+    real_batches = [torch.rand(3, 3, 32, 32) * 2 - 1]
+    for path in [weights_path, other_weights_path, weights_path]:
+        FIDEvaluator(torch.device('cpu'), path, cache_dir=cache_dir).load_reference(real_batches, dataset_id="data")
+    assert len(os.listdir(cache_dir)) == 2
@@ -0,0 +1,71 @@
+import subprocess
+
+import pytest
+import torch
+
+from conftest import run_train
+from losses import get_loss_function
+from models.FC import Discriminator, Generator
+from utils.grad_accumulation import accumulate_D_step, accumulate_G_step
+from utils.train_utils import calc_gradient_penalty
+
+MICRO_BS = 3
+
+
+@pytest.fixture
+def models():
+    torch.manual_seed(0)
+    return Generator(z_dim=8, output_dim=8, nf=32), Discriminator(input_dim=8, nf=32)
+
+
+def grads(model):
+    grad = [p.grad.clone() for p in model.parameters()]
+    model.zero_grad()
+    return grad
+
+
+def assert_close(grads_a, grads_b):
+    for a, b in zip(grads_a, grads_b):
+        assert torch.allclose(a, b, atol=1e-5)
+
+
+def test_accumulated_wgan_gp_D_gradients(models):
+    netG, netD = models
+    loss_function = get_loss_function("WGANLoss")
+    real, fake = torch.randn(8, 3, 8, 8), netG(torch.randn(8, 8)).detach()
+
+    torch.manual_seed(1)
+    Dloss, _ = loss_function.trainD(netD, real, fake)
+    gp, _ = calc_gradient_penalty(netD, real, fake)
+    (Dloss + 10 * gp).backward()
+    full_batch = grads(netD)
+
+    torch.manual_seed(1)
+    accumulate_D_step(loss_function, netD, real, fake, MICRO_BS, gp_weight=10,
+                      scaler=torch.amp.GradScaler('cpu', enabled=False))
+    assert_close(grads(netD), full_batch)
+
+
+@pytest.mark.parametrize("loss_name", ["MiniBatchLoss-dist=w1", "MiniBatchLoss-dist=swd"])
+def test_accumulated_minibatch_G_gradients(models, loss_name):
+    netG, netD = models
+    loss_function = get_loss_function(loss_name)
+    real, noise = torch.randn(8, 3, 8, 8), torch.randn(8, 8)
+
+    torch.manual_seed(1)
+    Gloss, _ = loss_function.trainG(netD, real, netG(noise))
+    Gloss.backward()
+    full_batch = grads(netG)
+
+    torch.manual_seed(1)
+    accumulate_G_step(loss_function, netG, netD, real, noise, MICRO_BS,
+                      scaler=torch.amp.GradScaler('cpu', enabled=False))
+    assert_close(grads(netG), full_batch)
+
+
+def test_micro_batches_are_refused_with_batch_norm(tmp_path, image_dir):
+    """Every micro batch would be normalized with its own statistics"""
+    with pytest.raises(subprocess.CalledProcessError) as error:
+        run_train(tmp_path, "--gen_arch", "DCGAN-normalize=bn", "--disc_arch", "FC", "--micro_bs", "2",
+                  "--n_workers", "0", "--n_iterations", "1", stderr=subprocess.PIPE)
+    assert b"--micro_bs can't be used with batch norm models" in error.value.stderr
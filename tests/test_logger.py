@@ -0,0 +1,41 @@
+import os
+import pickle
+from types import SimpleNamespace
+
+import torch
+
+from utils import logger as logger_module
+from utils.logger import PLTLogger, WandbLogger
+
+
+class FakeRun:
+    def __init__(self):
+        self.logs = []
+
+    def log(self, data_dict, step):
+        self.logs.append((step, data_dict))
+
+
+def test_wandb_gets_every_step(monkeypatch):
+    monkeypatch.setattr(logger_module.wandb, "init", lambda **kwargs: FakeRun())
+    logger = WandbLogger(SimpleNamespace(project_name="p", train_name="t"), None)
+    for step in range(3):
+        logger.log({"loss": torch.tensor(float(step))}, step=step)
+    logger.log({"swd": 0.5}, step=2)
+    logger.plot()
+    logger.log({"fid": 9}, step=1)  # e.g a late result of the evaluation worker
+    logger.log({"loss": torch.tensor(3.)}, step=3)
+    logger.close()
+    assert logger.wandb.logs == [(0, {"loss": 0.}), (1, {"loss": 1.}), (2, {"loss": 2., "swd": 0.5}),
+                                 (2, {"fid": 9.}), (3, {"loss": 3.})]
+
+
+def test_plt_logger_writes_pickled_averages(tmp_path):
+    logger = PLTLogger(None, str(tmp_path))
+    for window in range(2):
+        for step in range(2):
+            logger.log({"loss": torch.tensor(float(window * 2 + step))}, step=window * 2 + step)
+        logger.plot()
+    logger.close()
+    with open(os.path.join(tmp_path, "loss.pkl"), 'rb') as f:
+        assert pickle.load(f) == [0.5, 2.5]
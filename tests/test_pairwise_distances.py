@@ -0,0 +1,48 @@
+import os
+import sys
+
+import torch
+
+from utils.pairwise_distances import pairwise_distances
+
+sys.path.append(os.path.join(os.path.dirname(__file__), "..", "other_scripts"))
+
+
+def saved_bytes(fn):
+    """Total size of the distinct storages autograd saves for backward while running fn (views of a tensor count once)"""
+    storages = dict()
+
+    def pack(tensor):
+        storages[tensor.untyped_storage().data_ptr()] = tensor.untyped_storage().nbytes()
+        return tensor
+    with torch.autograd.graph.saved_tensors_hooks(pack, lambda tensor: tensor):
+        output = fn()
+    return output, sum(storages.values())
+
+
+def test_l1_budget_holds_with_gradients():
+    torch.manual_seed(0)
+    X = torch.randn(64, 32, requires_grad=True)
+    Y = torch.randn(48, 32)
+    max_bytes = 16 * 32 * 4  # 16 pairs of (32,) float differences per block
+
+    blocked, saved = saved_bytes(lambda: pairwise_distances(X, Y, p=1, max_bytes=max_bytes))
+    assert saved <= X.numel() * 4 + Y.numel() * 4 + max_bytes  # Not the (64, 48, 32) differences of all pairs
+    grad, = torch.autograd.grad(blocked.sum(), X)
+
+    full = torch.abs(X[:, None] - Y[None, :]).sum(-1)
+    expected_grad, = torch.autograd.grad(full.sum(), X)
+    assert torch.allclose(blocked, full, atol=1e-5)
+    assert torch.allclose(grad, expected_grad)
+
+
+def test_ot_means_distances_of_coinciding_points():
+    """A centroid equal to a data point is at a small positive distance instead of a NaN (rounding of the squared
+    distance) so that the OT plan and the Weiszfeld step stay finite"""
+    from ot_means import dist_mat
+    torch.manual_seed(0)
+    X = torch.rand(16, 3 * 64 * 64) * 2 - 1  # Images in [-1, 1]
+    D = dist_mat(X, X)
+    assert not torch.isnan(D).any()
+    assert (D.diagonal() < 1e-3 * D[0, 1]).all()
+    assert torch.allclose(D[0, 1], (X[0] - X[1]).norm(), rtol=1e-4)
@@ -0,0 +1,33 @@
+import os
+import shutil
+
+import pytest
+import torch
+
+from conftest import run_train
+
+
+def train(cwd, train_name, *extra_args, n_workers=0):
+    run_train(cwd, "--loss_function", "MiniBatchLoss-dist=swd", "--D_step_every", "-1", "--n_workers", str(n_workers),
+              "--log_freq", "2", "--save_every", "--n_iterations", "8", "--train_name", train_name, *extra_args)
+
+
+def load(cwd, train_name, iteration):
+    return torch.load(os.path.join(cwd, "outputs", "train_results", train_name, "models", f"{iteration}.pth"),
+                      weights_only=False)
+
+
+@pytest.mark.parametrize("n_workers", [0, 2])
+def test_resume_is_exact(tmp_path, image_dir, n_workers):
+    """A run resumed from the checkpoint of iteration 4 reaches the same weights as the run that wrote it"""
+    train(tmp_path, "full", n_workers=n_workers)
+    resumed_models = tmp_path / "outputs" / "train_results" / "resumed" / "models"
+    os.makedirs(resumed_models)
+    shutil.copy(tmp_path / "outputs" / "train_results" / "full" / "models" / "4.pth", resumed_models)
+    train(tmp_path, "resumed", "--resume_last_ckpt", n_workers=n_workers)
+
+    for iteration in [6, 7]:
+        full, resumed = load(tmp_path, "full", iteration), load(tmp_path, "resumed", iteration)
+        assert resumed['data_consumed'] == full['data_consumed']
+        for name, value in full['netG'].items():
+            assert torch.equal(resumed['netG'][name], value), name
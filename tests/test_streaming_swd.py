@@ -0,0 +1,27 @@
+import torch
+
+from utils.common import batch_generation, iterate_generation
+from utils.distribution_metrics import streaming_swd, swd
+from utils.train_utils import Prior
+
+
+def test_streaming_swd_matches_swd_after_generation():
+    """Generating lazily in a single chunk draws the noise and the projections in the same order as generating first"""
+    netG = torch.nn.Linear(8, 12)
+    y = torch.randn(40, 12)
+    prior = Prior("normal", 8)
+
+    torch.manual_seed(0)
+    expected = swd(batch_generation(netG, prior, 40, 64, torch.device('cpu')), y)[0]
+    torch.manual_seed(0)
+    streamed = streaming_swd(iterate_generation(netG, prior, 40, 64, torch.device('cpu')), y)[0]
+    assert torch.allclose(streamed, expected)
+
+
+def test_streaming_swd_of_chunks_matches_swd_of_concatenation():
+    x = torch.randn(50, 12)
+    y = torch.randn(40, 12)
+    torch.manual_seed(0)
+    expected = swd(x, y)[0]
+    torch.manual_seed(0)
+    assert torch.allclose(streaming_swd(torch.split(x, 16), y)[0], expected)
@@ -0,0 +1,39 @@
+import json
+import os
+import sys
+
+import numpy as np
+import torch
+
+from utils.data import shared_data_path, store_shared_data
+
+sys.path.append(os.path.join(os.path.dirname(__file__), "..", "other_scripts"))
+from experiment_utils import get_data
+from sweep import collect_metrics, data_variant
+
+
+def test_collects_the_last_logged_values(tmp_path):
+    os.makedirs(tmp_path / "plots")
+    with open(tmp_path / "plots" / "history.jsonl", 'w') as f:
+        f.write(json.dumps({"step": 0, "values": {"swd": [3.0, 0.5, 2.0], "fid": [9.0, 0.0, 9.0]}}) + "\n")
+        f.write(json.dumps({"step": 10, "values": {"swd": [1.5, 0.5, 1.0]}}) + "\n")
+    assert collect_metrics({"output_dir": str(tmp_path)}) == {"swd": 1.0, "fid": 9.0}
+
+
+def test_data_variants_use_the_scripts_defaults():
+    assert data_variant({"script": "other_scripts/batch_size_effect.py", "args": ["--data_path", "x"]}) == \
+        ("x", 64, None, False, 10000)
+    assert data_variant({"script": "other_scripts/ot_means.py", "args": ["--data_path", "x", "--im_size", "32"]}) == \
+        ("x", 32, None, False, None)
+
+
+def test_scripts_share_the_data_without_copies(tmp_path, image_dir, monkeypatch):
+    monkeypatch.setenv("SHARED_DATA_DIR", str(tmp_path / "shared"))
+    os.makedirs(tmp_path / "shared")
+    store_shared_data(image_dir, 16)
+    data = get_data(image_dir, 16)
+    # Writes to the shared file show through the (copy-on-write) mapping as long as the process didn't write the pages
+    shared = np.load(shared_data_path(image_dir, 16), mmap_mode='r+')
+    shared[0] = 7
+    shared.flush()
+    assert torch.all(data[0] == 7)
@@ -0,0 +1,29 @@
+import torch
+from torch import nn
+
+from losses import get_loss_function
+from utils.metrics import vgg_dist_calculator
+
+
+def small_vgg():
+    """A vgg_dist_calculator over a small random network instead of the pretrained VGG19"""
+    torch.manual_seed(0)
+    vgg = vgg_dist_calculator.__new__(vgg_dist_calculator)
+    vgg.layer_idx = 3
+    vgg.device = None
+    vgg.cache = None
+    vgg.vgg_features = nn.Sequential(nn.Conv2d(3, 4, 3), nn.ReLU(inplace=True), nn.Conv2d(4, 4, 3), nn.ReLU(inplace=True))
+    vgg.vgg_features.requires_grad_(False)
+    vgg.normalize = lambda x: x
+    return vgg
+
+
+def test_vgg_loss_backward_through_generated_features():
+    """The real images' features are extracted without gradients and compared to features that require them"""
+    for dist, patch_features in [("swd", True), ("w1", True), ("nn", True), ("w1", False), ("nn", False)]:
+        loss_function = get_loss_function(f"MiniBatchVGGLoss-dist={dist}-layers=[1,3]-patch_features={patch_features}")
+        loss_function.vgg = small_vgg()
+        fake = torch.rand(4, 3, 12, 12, requires_grad=True)
+        loss, _ = loss_function.trainG(None, torch.rand(4, 3, 12, 12), fake)
+        loss.backward()
+        assert fake.grad is not None
@@ -1,24 +1,71 @@
 import argparse
-from time import time
+import os
+from time import time, perf_counter
 
 import torch
-
-from utils.common import dump_images, compose_experiment_name, batch_generation
-from utils.train_utils import copy_G_params, load_params, Prior, get_models_and_optimizers, parse_train_args, \
-    save_model, calc_gradient_penalty
+import torch.distributed as dist
+from torch import optim
+from torch.nn.parallel import DistributedDataParallel
+from torch.nn.utils import parametrize
+
+from utils.common import dump_images, compose_experiment_name, batch_generation, iterate_generation
+from utils.train_utils import EMA, Prior, get_models_and_optimizers, parse_train_args, \
+    save_model, calc_gradient_penalty, compile_models, has_batch_norm, get_rng_state, set_rng_state
 from losses import get_loss_function
-from utils.data import get_dataloader
+from models import get_models
+from models.model_utils.fusion import fold_batch_norms
+from utils.checkpoint import CheckpointWriter
+from utils.data import get_dataloader, get_dataset, BatchStream
+from utils.distributed import init_distributed, is_distributed, is_main_process, unwrap, broadcast_from_main, \
+    GlobalBatchLoss, NullLogger
+from utils.ensemble import GeneratorEnsemble, EnsembleLoss
+from utils.eval_worker import EvaluationWorker
+from utils.feature_cache import FeatureCache
+from utils.grad_accumulation import generate_in_chunks, accumulate_D_step, accumulate_G_step
 from utils.logger import get_dir, PLTLogger, WandbLogger
+from utils.profiling import timer, span, TraceWindow
 
 
 def train_GAN(args):
-    logger = (WandbLogger if args.wandb else PLTLogger)(args, plots_image_folder)
-
-    prior, netG, netD, optimizerG, optimizerD, start_iteration = get_models_and_optimizers(args, device, saved_model_folder)
+    main_process = is_main_process()  # Only the main rank logs, evaluates and saves checkpoints
+    logger = (WandbLogger if args.wandb else PLTLogger)(args, plots_image_folder) if main_process else NullLogger()
+
+    prior, netG, netD, optimizerG, optimizerD, resume_ckpt = get_models_and_optimizers(args, device, saved_model_folder)
+    if args.micro_bs is not None and (has_batch_norm(netG) or has_batch_norm(netD)):
+        raise ValueError("--micro_bs can't be used with batch norm models: every micro batch would be normalized with "
+                         "its own statistics so the accumulated gradients wouldn't match the full batch ones")
+    start_iteration = 0
+    if resume_ckpt is not None:
+        start_iteration = resume_ckpt['iteration'] + 1  # The checkpoint is saved at the end of its iteration
+        if 'logger' in resume_ckpt:
+            logger.load_state_dict(resume_ckpt['logger'])
+
+    # Models and image batches share a memory format (parameters are converted in place: optimizers are unaffected)
+    memory_format = torch.channels_last if args.memory_format == 'channels_last' else torch.contiguous_format
+    netG.to(memory_format=memory_format)
+    netD.to(memory_format=memory_format)
+
+    # Persistent workers load batches ahead of the training step for the whole run
+    train_stream = BatchStream(train_dataset, local_r_bs, args.n_workers, device, seed=args.data_seed,
+                               prefetch=args.prefetch, rank=rank, world_size=world_size,
+                               start_batch=resume_ckpt.get('data_consumed', 0) if resume_ckpt is not None else 0,
+                               memory_format=memory_format)
 
     debug_fixed_noise = prior.sample(args.f_bs).to(device)
-    debug_fixed_reals = next(iter(train_loader)).to(device)
-    debug_all_reals = next(iter(full_batch_loader)).to(device)
+    if is_distributed():
+        if prior.z is not None:
+            prior.z = broadcast_from_main(prior.z, device)  # All ranks share the same latent table
+        torch.manual_seed(torch.initial_seed() + dist.get_rank())  # But sample different noise (see GlobalBatchLoss)
+    debug_fixed_reals = train_stream.get_batch(0).to(device)
+    debug_all_reals = next(iter(full_batch_loader)).to(device, memory_format=memory_format)
+
+    fid_evaluator = None
+    if args.fid_n_batches > 0 and main_process:
+        from benchmarking.fid import FIDEvaluator
+        fid_evaluator = FIDEvaluator(device, args.fid_weights)
+        fid_evaluator.load_reference((train_stream.get_batch(k) for k in range(args.fid_n_batches)),
+                                     dataset_id=(args.data_path, args.im_size, args.center_crop, args.gray_scale,
+                                                 args.limit_data, args.r_bs, args.fid_n_batches))
 
     other_metrics = [
                 # get_loss_function("MiniBatchLoss-dist=w1"),
@@ -27,110 +74,328 @@ def train_GAN(args):
                 # get_loss_function("MiniBatchPatchLoss-dist=swd-p=8-s=4"),
                 # get_loss_function("MiniBatchPatchLoss-dist=swd-p=16-s=8"),
               ]
+    set_feature_cache(other_metrics)
 
     loss_function = get_loss_function(args.loss_function)
-
-
-    avg_param_G = copy_G_params(netG)
+    if args.compile:
+        compile_models(netG, netD, loss_function, args.gp_weight)
+
+    # Real, fake and interpolated samples can share a single netD forward if netD treats samples independently
+    fused_gp = args.gp_weight > 0 and hasattr(loss_function, 'trainD_fused') and not has_batch_norm(netD)
+
+
+    ema = EMA(netG, args.avg_update_factor)
+    if resume_ckpt is not None and 'netG_train' in resume_ckpt:
+        ema.load_state_dict(resume_ckpt['netG'])
+    ckpt_writer = CheckpointWriter(saved_model_folder, keep_last=args.keep_last_ckpts)
+
+    if is_distributed():
+        device_ids = None if device.type == 'cpu' else [device.index]
+        netG = DistributedDataParallel(netG, device_ids=device_ids)
+        netD = DistributedDataParallel(netD, device_ids=device_ids)
+        if not getattr(loss_function, 'per_sample_loss', False):
+            loss_seed = int(broadcast_from_main(torch.randint(2**62, (1,)), device))
+            loss_function = GlobalBatchLoss(loss_function, seed=loss_seed)
+
+    eval_worker = None
+    if args.eval_worker_threads > 0 and main_process:
+        # Evaluate generator snapshots in a separate process with its own thread budget
+        eval_worker = EvaluationWorker(evaluate, ema.model, args.eval_worker_threads, prior=prior,
+                                       other_metrics=other_metrics, fixed_noise=debug_fixed_noise.cpu(),
+                                       debug_fixed_reals=debug_fixed_reals.cpu(), debug_all_reals=debug_all_reals.cpu(),
+                                       saved_image_folder=saved_image_folder, args=args)
+
+    # Mixed precision: G/D forwards are autocasted while distribution metrics run in float32 (see distribution_metrics)
+    amp_dtype = {'bf16': torch.bfloat16, 'fp16': torch.float16}.get(args.amp)
+    autocast = lambda: torch.autocast(device_type=device.type, dtype=amp_dtype, enabled=amp_dtype is not None)
+    scaler = torch.amp.GradScaler(device.type, enabled=args.amp == 'fp16')  # bf16 has float32's range: no scaling needed
+    if resume_ckpt is not None and 'scaler' in resume_ckpt:
+        scaler.load_state_dict(resume_ckpt['scaler'])
+
+    timer.enabled = args.profile
+    timer.synchronize = args.profile and device.type == 'cuda'
+    trace_window = None
+    if args.profile_window is not None:
+        trace_start, trace_end = map(int, args.profile_window.split(":"))
+        trace_window = TraceWindow(trace_start, trace_end, os.path.join(plots_image_folder, f"trace_{args.profile_window}.json"))
+
+    # Continue the random streams where the checkpoint left them (ranks of a distributed run keep their own seeds)
+    if resume_ckpt is not None and 'rng' in resume_ckpt and not is_distributed():
+        set_rng_state(resume_ckpt['rng'])
+    resume_ckpt = None
 
     start = time()
     iteration = start_iteration
     while iteration < args.n_iterations:
-        for real_images in train_loader:
-            real_images = real_images.to(device)
+        if trace_window is not None:
+            trace_window.step(iteration)
+        data_start = perf_counter()
+        real_images = next(train_stream)
+        timer.record("data", perf_counter() - data_start)
 
+        with span("G_forward"):
             noise = prior.sample(args.f_bs).to(device)
-            fake_images = netG(noise)
-
-            # #####  1. train Discriminator #####
-            if iteration % args.D_step_every == 0 and args.D_step_every > 0:
-                Dloss, debug_Dlosses = loss_function.trainD(netD, real_images, fake_images)
-                if args.gp_weight > 0:
-                    gp, gradient_norm = calc_gradient_penalty(netD, real_images, fake_images)
-                    debug_Dlosses['gradient_norm'] = gradient_norm
-                    Dloss += args.gp_weight * gp
-                    if "W1" in debug_Dlosses:
-                        debug_Dlosses['normalized W1'] = (debug_Dlosses['W1'] /  gradient_norm) if  gradient_norm > 0 else 0
-                netD.zero_grad()
-                Dloss.backward()
-                optimizerD.step()
+            with autocast():
+                if args.micro_bs is not None:
+                    fake_images = generate_in_chunks(netG, noise, args.micro_bs)
+                else:
+                    fake_images = netG(noise)
 
+        # #####  1. train Discriminator #####
+        if iteration % args.D_step_every == 0 and args.D_step_every > 0 and args.micro_bs is not None:
+            with span("D_accumulation"):
+                netD.zero_grad()
+                debug_Dlosses = accumulate_D_step(loss_function, netD, real_images, fake_images, args.micro_bs,
+                                                  args.gp_weight, scaler, autocast)
+            with span("D_optimizer"):
+                scaler.step(optimizerD)
                 if args.weight_clipping is not None:
                     for p in netD.parameters():
                         p.data.clamp_(-args.weight_clipping, args.weight_clipping)
 
-                logger.log(debug_Dlosses, step=iteration)
+            logger.log(debug_Dlosses, step=iteration)
+
+        elif iteration % args.D_step_every == 0 and args.D_step_every > 0:
+            # Spectrally normalized weights are computed once for all the forwards of the step
+            with parametrize.cached():
+                with span("D_loss"), autocast():
+                    if fused_gp and len(real_images) == len(fake_images):
+                        Dloss, debug_Dlosses, gp, gradient_norm = loss_function.trainD_fused(netD, real_images, fake_images,
+                                                                                              scaler=scaler)
+                    else:
+                        Dloss, debug_Dlosses = loss_function.trainD(netD, real_images, fake_images)
+                        if args.gp_weight > 0:
+                            with span("gradient_penalty"):
+                                gp, gradient_norm = calc_gradient_penalty(netD, real_images, fake_images, scaler=scaler)
+                    if args.gp_weight > 0:
+                        debug_Dlosses['gradient_norm'] = gradient_norm
+                        Dloss += args.gp_weight * gp
+                        if "W1" in debug_Dlosses:
+                            debug_Dlosses['normalized W1'] = torch.where(gradient_norm > 0, debug_Dlosses['W1'] / gradient_norm,
+                                                                         torch.zeros_like(gradient_norm))
+                with span("D_backward"):
+                    netD.zero_grad()
+                    scaler.scale(Dloss).backward()
+            with span("D_optimizer"):
+                scaler.step(optimizerD)
 
-            # #####  2. train Generator #####
-            if iteration % args.G_step_every == 0:
-                if not args.no_fake_resample:
-                    noise = prior.sample(args.f_bs).to(device)
-                    fake_images = netG(noise)
+                if args.weight_clipping is not None:
+                    for p in netD.parameters():
+                        p.data.clamp_(-args.weight_clipping, args.weight_clipping)
 
-                Gloss, debug_Glosses = loss_function.trainG(netD, real_images, fake_images)
-                netG.zero_grad()
-                Gloss.backward()
-                optimizerG.step()
-                logger.log(debug_Glosses, step=iteration)
+            logger.log(debug_Dlosses, step=iteration)
 
-            # Update avg weights
-            for p, avg_p in zip(netG.parameters(), avg_param_G):
-                avg_p.mul_(1 - args.avg_update_factor).add_(args.avg_update_factor * p.data)
+        # #####  2. train Generator #####
+        if iteration % args.G_step_every == 0 and args.micro_bs is not None:
+            if not args.no_fake_resample:
+                noise = prior.sample(args.f_bs).to(device)
+            with span("G_accumulation"):
+                netG.zero_grad()
+                debug_Glosses = accumulate_G_step(loss_function, netG, unwrap(netD), real_images, noise, args.micro_bs,
+                                                  scaler, autocast)
+            with span("G_optimizer"):
+                scaler.step(optimizerG)
+            logger.log(debug_Glosses, step=iteration)
+
+        elif iteration % args.G_step_every == 0:
+            with parametrize.cached():
+                with span("G_loss"), autocast():
+                    if not args.no_fake_resample:
+                        noise = prior.sample(args.f_bs).to(device)
+                        fake_images = netG(noise)
+
+                    # netD's gradients of the G step are discarded: don't synchronize them across ranks
+                    Gloss, debug_Glosses = loss_function.trainG(unwrap(netD), real_images, fake_images)
+                with span("G_backward"):
+                    netG.zero_grad()
+                    scaler.scale(Gloss).backward()
+            with span("G_optimizer"):
+                scaler.step(optimizerG)
+            logger.log(debug_Glosses, step=iteration)
+
+        # The loss scale is updated once per iteration after the steps of both optimizers (AMP's multi-optimizer usage)
+        if iteration % args.G_step_every == 0 or (iteration % args.D_step_every == 0 and args.D_step_every > 0):
+            scaler.update()
+
+        with span("ema"):
+            ema.update()
+
+        if iteration % 100 == 0 and main_process:
+            it_sec = max(1, iteration - start_iteration) / (time() - start)
+            print(f"Iteration: {iteration}: it/sec: {it_sec:.1f}")
+            if eval_worker is not None:
+                eval_worker.poll(logger)
+            if timer.enabled:
+                logger.log(timer.summary(), step=iteration)
+            logger.plot()
+
+        log_step = iteration % args.log_freq == 0 or iteration == args.n_iterations - 1  # Also log the final state
+        if log_step and main_process:
+            with span("evaluation"):
+                if eval_worker is not None:
+                    eval_worker.submit(ema.model, iteration, wait=iteration == args.n_iterations - 1)
+                else:
+                    evaluate(prior, ema.model, other_metrics, debug_fixed_noise,
+                             debug_fixed_reals, debug_all_reals, saved_image_folder, iteration, logger, args)
+
+        if fid_evaluator is not None and iteration % args.fid_freq == 0:  # Only on the main rank
+            with span("fid"):
+                evaluate_fid(prior, ema.model, fid_evaluator, iteration, logger, args)
+
+        # Checkpoint last: a run resumed from it continues exactly as this one does from the next iteration
+        if log_step and main_process:
+            with span("checkpoint"):
+                logger.plot()  # Close the logging window so the logged history matches the checkpoint
+                training_state = dict(rng=get_rng_state(), data_consumed=train_stream.consumed,
+                                      logger=logger.state_dict(), scaler=scaler.state_dict())
+                if ema.shadow is not None:
+                    training_state['netG_train'] = unwrap(netG).state_dict()
+                save_model(prior, ema.model, unwrap(netD), optimizerG, optimizerD, saved_model_folder, iteration, args,
+                           ckpt_writer, **training_state)
+
+        iteration += 1
+
+    train_stream.close()
+    ckpt_writer.close()
+    if trace_window is not None:
+        trace_window.close()
+    if eval_worker is not None:
+        eval_worker.close(logger)
+    logger.close()
+    if is_distributed():
+        dist.destroy_process_group()
+
+
+def train_ensemble(args):
+    """
+    Train args.ensemble generators with different initializations at once: their parameters are stacked and every step
+    runs all members in a single vmapped forward and loss (see utils/ensemble.py). Each member is logged, evaluated and
+    saved in its own folder. Supports the discriminator-free minibatch losses (--D_step_every -1) without EMA
+    """
+    assert args.D_step_every <= 0 and args.avg_update_factor == 1, "Ensembles train generators with minibatch losses only"
+    assert not is_distributed() and args.micro_bs is None and not args.resume_last_ckpt
+
+    members = []
+    for m in range(args.ensemble):
+        netG, _ = get_models(args, device)
+        members.append(netG.train())
+    assert not getattr(members[0], 'sparse', False), "Sparse gradients can't be vmapped"
+    prior = Prior(args.z_prior, args.z_dim, use_indices=getattr(members[0], 'takes_indices', False))
+    ensemble = GeneratorEnsemble(members)
+    optimizerG = optim.Adam(ensemble.parameters(), lr=args.lrG, betas=(0.5, 0.9))
+    loss_function = EnsembleLoss(get_loss_function(args.loss_function))
+    other_metrics = [get_loss_function("MiniBatchLoss-dist=swd")]
+    set_feature_cache(other_metrics)
+
+    member_folders = []
+    for m in range(args.ensemble):
+        folders = [os.path.join(folder, f"member-{m}") for folder in
+                   (saved_model_folder, saved_image_folder, plots_image_folder)]
+        for folder in folders:
+            os.makedirs(folder, exist_ok=True)
+        member_folders.append(folders)
+    loggers = [(WandbLogger if args.wandb else PLTLogger)(args, plots_folder) for _, _, plots_folder in member_folders]
+    ckpt_writer = CheckpointWriter(saved_model_folder)
+
+    train_stream = BatchStream(train_dataset, local_r_bs, args.n_workers, device, seed=args.data_seed,
+                               prefetch=args.prefetch)
+    debug_fixed_noise = prior.sample(args.f_bs).to(device)
+    debug_fixed_reals = train_stream.get_batch(0).to(device)
+    debug_all_reals = next(iter(full_batch_loader)).to(device)
 
-            if iteration % 100 == 0:
-                it_sec = max(1, iteration - start_iteration) / (time() - start)
-                print(f"Iteration: {iteration}: it/sec: {it_sec:.1f}")
+    start = time()
+    for iteration in range(args.n_iterations):
+        real_images = next(train_stream)
+        noise = torch.stack([prior.sample(args.f_bs) for _ in range(args.ensemble)]).to(device)
+        fake_images = ensemble(noise)
+        Glosses, debug_Glosses = loss_function(real_images, fake_images)
+        optimizerG.zero_grad()
+        Glosses.sum().backward()  # Members don't share parameters: each gets the gradient of its own loss
+        optimizerG.step()
+
+        for m, logger in enumerate(loggers):
+            logger.log({k: v[m] for k, v in debug_Glosses.items()}, step=iteration)
+
+        if iteration % 100 == 0:
+            it_sec = max(1, iteration) / (time() - start)
+            print(f"Iteration: {iteration}: it/sec: {it_sec:.1f} ({args.ensemble} members)")
+            for logger in loggers:
                 logger.plot()
 
-            if iteration % args.log_freq == 0:
-                backup_para = copy_G_params(netG)
-                load_params(netG, avg_param_G)
-
-                evaluate(prior, netG, netD, other_metrics, debug_fixed_noise,
-                         debug_fixed_reals, debug_all_reals, saved_image_folder, iteration, logger, args)
+        if iteration % args.log_freq == 0:
+            for m, (model_folder, image_folder, _) in enumerate(member_folders):
+                netG = ensemble.member(m)
+                evaluate(prior, netG, other_metrics, debug_fixed_noise, debug_fixed_reals, debug_all_reals,
+                         image_folder, iteration, loggers[m], args)
+                fname = f"{model_folder}/{'last' if not args.save_every else iteration}.pth"
+                ckpt_writer.save({"iteration": iteration, 'prior': prior.z, 'netG': netG.state_dict()}, fname)
 
-                save_model(prior, netG, netD, optimizerG, optimizerD, saved_model_folder, iteration, args)
+    train_stream.close()
+    ckpt_writer.close()
+    for logger in loggers:
+        logger.close()
 
-                load_params(netG, backup_para)
 
-            iteration += 1
+def set_feature_cache(metrics):
+    """Metrics on deep features (e.g MiniBatchVGGLoss) extract the features of the whole train data only once"""
+    feature_cache = FeatureCache()
+    for metric in metrics:
+        metric.cache = feature_cache
 
 
-def evaluate(prior, netG, netD, other_metrics, fixed_noise, debug_fixed_reals,
+def evaluate(prior, netG, other_metrics, fixed_noise, debug_fixed_reals,
              debug_all_reals, saved_image_folder, iteration, logger, args):
     netG.eval()
-    netD.eval()
+    # Generate with an inference copy whose batch norms are folded into the convolutions
+    netG_inference = fold_batch_norms(netG) if has_batch_norm(netG) else netG
     start = time()
     with torch.no_grad():
-        fake_images = batch_generation(netG, prior, len(debug_all_reals), 512, torch.device("cpu"))
-
-        print(f"Computing metrics between {len(debug_all_reals)} real and {len(fake_images)} fake images")
+        # A single metric consumes the generated images chunk by chunk, several metrics share a generated buffer
+        if len(other_metrics) == 1:
+            fake_batches = iterate_generation(netG_inference, prior, len(debug_all_reals), 512, torch.device("cpu"))
+        else:
+            fake_batches = [batch_generation(netG_inference, prior, len(debug_all_reals), 512, torch.device("cpu"))]
+
+        print(f"Computing metrics between {len(debug_all_reals)} real and generated images")
+        reals_id = (args.data_path, args.im_size, args.center_crop, args.gray_scale, args.limit_data)
         for metric in other_metrics:
             logger.log({
-                f'{metric.name}_fixed_noise_gen_to_train': metric(fake_images.cpu(), debug_all_reals.cpu()),
+                f'{metric.name}_fixed_noise_gen_to_train': metric.from_batches(fake_batches, debug_all_reals.cpu(),
+                                                                                Y_id=reals_id),
             }, step=iteration)
 
-        dump_images(netG(fixed_noise),  f'{saved_image_folder}/{iteration}.png')
+        dump_images(netG_inference(fixed_noise),  f'{saved_image_folder}/{iteration}.png')
         if iteration == 0:
             dump_images(debug_fixed_reals, f'{saved_image_folder}/debug_fixed_reals.png')
 
     netG.train()
-    netD.train()
     print(f"Evaluation finished in {time()-start} seconds")
 
 
+def evaluate_fid(prior, netG, fid_evaluator, iteration, logger, args):
+    """Stream 'fid_n_batches' batches of generated images through the FID evaluator"""
+    netG.eval()
+    start = time()
+    with torch.no_grad():
+        fake_batches = (netG(prior.sample(args.f_bs).to(device)) for _ in range(args.fid_n_batches))
+        logger.log(fid_evaluator(fake_batches), step=iteration)
+    netG.train()
+    print(f"FID evaluation finished in {time()-start} seconds")
+
+
 if __name__ == "__main__":
     args = parse_train_args()
+    rank, world_size = init_distributed(args)
 
     device = torch.device(args.device)
     if args.device != 'cpu':
         print(f"Working on device: {torch.cuda.get_device_name(device)}")
 
-    train_loader, _ = get_dataloader(args.data_path, args.im_size, args.r_bs, args.n_workers,
-                                               val_percentage=0, gray_scale=args.gray_scale, center_crop=args.center_crop,
-                                               load_to_memory=args.load_data_to_memory, limit_data=args.limit_data)
-
-    data_size = len(train_loader.dataset)
+    train_dataset = get_dataset(args.data_path, args.im_size, gray_scale=args.gray_scale, center_crop=args.center_crop,
+                                load_to_memory=args.load_data_to_memory, limit_data=args.limit_data)
+    data_size = len(train_dataset)
+    # Batch sizes are global: with torchrun every rank handles 1/world_size of each batch
+    local_r_bs = (data_size if args.r_bs == -1 else args.r_bs) // world_size
     print(f"eval loader size {data_size}")
     full_batch_loader, _ = get_dataloader(args.data_path, args.im_size, data_size, args.n_workers,
                                                val_percentage=0, gray_scale=args.gray_scale, center_crop=args.center_crop,
@@ -143,8 +408,12 @@ if __name__ == "__main__":
         args.train_name = compose_experiment_name(args)
 
     saved_model_folder, saved_image_folder, plots_image_folder = get_dir(args)
+    args.f_bs = args.f_bs // world_size
 
-    train_GAN(args)
+    if args.ensemble > 1:
+        train_ensemble(args)
+    else:
+        train_GAN(args)
 
 
 
@@ -0,0 +1,88 @@
+import atexit
+import os
+import pickle
+import queue
+import re
+import threading
+import warnings
+
+import torch
+
+
+def to_cpu(obj):
+    """Recursively copy the tensors of a (nested) state dict to the CPU so it can be written while training continues"""
+    if torch.is_tensor(obj):
+        return obj.detach().to('cpu', copy=True)
+    if isinstance(obj, dict):
+        return {k: to_cpu(v) for k, v in obj.items()}
+    if isinstance(obj, (list, tuple)):
+        return type(obj)(to_cpu(v) for v in obj)
+    return obj
+
+
+def atomic_save(state, fname):
+    """Write to a temporary file and rename it so that a crash never leaves a partially written checkpoint"""
+    torch.save(state, fname + ".tmp")
+    os.replace(fname + ".tmp", fname)
+
+
+def load_checkpoint(path, map_location='cpu'):
+    """Load a checkpoint with memory-mapped tensors (falls back to a regular load for legacy files / older torch).
+    Checkpoints holding objects that the weights_only default of torch>=2.6 refuses are fully unpickled with a warning:
+    only load checkpoints you trust"""
+    try:
+        try:
+            return torch.load(path, map_location=map_location, mmap=True)
+        except (TypeError, RuntimeError):
+            return torch.load(path, map_location=map_location)
+    except pickle.UnpicklingError as e:
+        warnings.warn(f"{path} can't be loaded with weights_only=True ({e}), unpickling it without restrictions")
+        return torch.load(path, map_location=map_location, weights_only=False)
+
+
+class CheckpointWriter:
+    """
+    Write checkpoints on a background thread: states are snapshot to the CPU when 'save' is called and written
+    atomically by the thread. Only the 'keep_last' latest '<iteration>.pth' checkpoints in the folder are kept (0 keeps
+    all), other files (e.g last.pth or loaded weights) are never removed
+    """
+    def __init__(self, folder, keep_last=0, max_pending=2):
+        self.folder = folder
+        self.keep_last = keep_last
+        self.queue = queue.Queue(maxsize=max_pending)  # Bounds the memory held by pending snapshots
+        self.thread = threading.Thread(target=self._run, daemon=True)
+        self.thread.start()
+        atexit.register(self.close)  # Flush pending checkpoints even if training stops with an exception
+
+    def save(self, state, fname):
+        self.queue.put((to_cpu(state), fname))
+
+    def _run(self):
+        while True:
+            item = self.queue.get()
+            if item is None:
+                self.queue.task_done()
+                break
+            state, fname = item
+            try:
+                atomic_save(state, fname)
+                self._remove_old_checkpoints()
+            except Exception as e:
+                print(f"Failed writing checkpoint {fname}: {e}")
+            self.queue.task_done()
+
+    def _remove_old_checkpoints(self):
+        if self.keep_last > 0:
+            names = [name for name in os.listdir(self.folder) if re.fullmatch(r'\d+\.pth', name)]
+            names.sort(key=lambda name: int(name[:-len('.pth')]))
+            for name in names[:-self.keep_last]:
+                os.remove(os.path.join(self.folder, name))
+
+    def wait(self):
+        """Block until all pending checkpoints are written"""
+        self.queue.join()
+
+    def close(self):
+        if self.thread.is_alive():
+            self.queue.put(None)
+            self.thread.join()
@@ -1,6 +1,7 @@
 import os
 from math import sqrt
 
+import numpy as np
 import torch
 from torchvision.utils import save_image
 
@@ -44,19 +45,33 @@ def hash_vectors(x, n=1000):
     return (decimals / 10 ** l * n).to(torch.long)
 
 
-def batch_generation(netG, prior, n, b, device):
-    if "const" in prior.prior_type: # generate images for all 'm' zs
-        fake_data = netG(prior.z.to(next(netG.parameters()).device)).to(device)
-    else: # Generate 'n' images for random zs in batches of size b
-        n_batches = n // b
-        fake_data = []
-        for i in range(n_batches):
-            z = prior.sample(b)
-            z = z.to(next(netG.parameters()).device)
-            fake_data.append(netG(z).to(device))
-        if n_batches * b < n:
-            z = prior.sample(n - n_batches * b)
-            z = z.to(next(netG.parameters()).device)
-            fake_data.append(netG(z).to(device))
-        fake_data = torch.cat(fake_data)
-    return fake_data
+def iterate_generation(netG, prior, n, b, device):
+    """Yield the images of n samples of the prior (all K latents of a 'const' prior) in chunks of at most b images"""
+    netG_device = next(netG.parameters()).device
+    if "const" in prior.prior_type:
+        chunks = torch.split(prior.sample(prior.b), b)
+    else:
+        chunks = (prior.sample(min(b, n - i)) for i in range(0, n, b))
+    for z in chunks:
+        with torch.inference_mode():
+            images = netG(z.to(netG_device)).to(device)
+        yield images
+
+
+def batch_generation(netG, prior, n, b, device, out=None):
+    """
+    Generate n images (all K images of a 'const' prior) in chunks of b images.
+    param out: optional preallocated (n, c, h, w) tensor or numpy array (e.g a np.lib.format.open_memmap) to write into
+    """
+    if "const" in prior.prior_type:
+        n = prior.b
+    start = 0
+    for images in iterate_generation(netG, prior, n, b, device):
+        if out is None:
+            out = torch.empty((n, *images.shape[1:]), dtype=images.dtype, device=device)
+        if isinstance(out, np.ndarray):
+            out[start: start + len(images)] = images.cpu().numpy()
+        else:
+            out[start: start + len(images)] = images
+        start += len(images)
+    return out
@@ -1,10 +1,13 @@
+import hashlib
 import os
+import queue
+import threading
 from random import shuffle
 
 import numpy as np
 import torch
 import torch.utils.data as data
-from torch.utils.data import Dataset, DataLoader
+from torch.utils.data import Dataset, DataLoader, Sampler, default_collate
 from PIL import Image
 from torchvision import transforms as T
 from tqdm import tqdm
@@ -63,13 +66,72 @@ class DiskDataset(Dataset):
         return img
 
 
-def get_dataloader(data_root, im_size, batch_size, n_workers, val_percentage=0,
-                   load_to_memory=False, limit_data=None, gray_scale=False, center_crop=None):
+class ArrayDataset(Dataset):
+    """Images already decoded and transformed into an (N, c, h, w) array, e.g a memory-mapped shared data file"""
+    def __init__(self, images):
+        super(ArrayDataset, self).__init__()
+        self.images = images
+
+    def __len__(self):
+        return len(self.images)
+
+    def __getitem__(self, idx):
+        return torch.from_numpy(np.array(self.images[idx]))
+
+
+def shared_data_path(data_root, im_size, center_crop=None, gray_scale=False, limit_data=None, shared_dir=None):
+    """
+    Path of the shared data file of a dataset variant in 'shared_dir' (defaults to $SHARED_DATA_DIR, e.g a /dev/shm folder
+    filled by other_scripts/sweep.py). None if there is no shared data dir
+    """
+    shared_dir = shared_dir or os.environ.get("SHARED_DATA_DIR")
+    if shared_dir is None:
+        return None
+    variant = (os.path.abspath(data_root), im_size, center_crop, gray_scale, limit_data)
+    return os.path.join(shared_dir, hashlib.sha1(str(variant).encode()).hexdigest()[:16] + ".npy")
+
+
+def store_shared_data(data_root, im_size, center_crop=None, gray_scale=False, limit_data=None, shared_dir=None):
+    """Decode a dataset variant once into its shared data file. Returns the file size in bytes"""
+    path = shared_data_path(data_root, im_size, center_crop, gray_scale, limit_data, shared_dir)
+    if not os.path.exists(path):
+        dataset = MemoryDataset(get_paths(data_root, limit_data), im_size, center_crop=center_crop, gray_scale=gray_scale)
+        np.save(path + ".tmp.npy", torch.stack(dataset.images).numpy())
+        os.replace(path + ".tmp.npy", path)
+    return os.path.getsize(path)
+
+
+def load_shared_data(data_root, im_size, center_crop=None, gray_scale=False, limit_data=None, mmap_mode='r'):
+    """Memory-map the shared data file of a dataset variant if one was stored. Returns None otherwise.
+    With mmap_mode='c' the array is writable but pages are only copied by the processes that write to them"""
+    path = shared_data_path(data_root, im_size, center_crop, gray_scale, limit_data)
+    if path is None or not os.path.exists(path):
+        return None
+    print(f"Using shared data {path}")
+    return np.load(path, mmap_mode=mmap_mode)
+
+
+def get_paths(data_root, limit_data=None):
     # paths = [os.path.join(data_root, im_name) for im_name in os.listdir(data_root)]
     # shuffle(paths)
     paths = sorted([os.path.join(data_root, im_name) for im_name in os.listdir(data_root)])
     if limit_data is not None:
         paths = paths[:limit_data]
+    return paths
+
+
+def get_dataset(data_root, im_size, load_to_memory=False, limit_data=None, gray_scale=False, center_crop=None):
+    shared_images = load_shared_data(data_root, im_size, center_crop, gray_scale, limit_data)
+    if shared_images is not None:
+        return ArrayDataset(shared_images)
+    dataset_type = MemoryDataset if load_to_memory else DiskDataset
+    return dataset_type(paths=get_paths(data_root, limit_data), im_size=im_size, gray_scale=gray_scale,
+                        center_crop=center_crop)
+
+
+def get_dataloader(data_root, im_size, batch_size, n_workers, val_percentage=0,
+                   load_to_memory=False, limit_data=None, gray_scale=False, center_crop=None):
+    paths = get_paths(data_root, limit_data)
     if batch_size == -1: batch_size = len(paths)
 
     n_val_images = int(val_percentage * len(paths))
@@ -78,7 +140,11 @@ def get_dataloader(data_root, im_size, batch_size, n_workers, val_percentage=0,
 
     dataset_type = MemoryDataset if load_to_memory else DiskDataset
 
-    train_dataset = dataset_type(paths=train_paths, im_size=im_size, gray_scale=gray_scale, center_crop=center_crop)
+    shared_images = load_shared_data(data_root, im_size, center_crop, gray_scale, limit_data) if n_val_images == 0 else None
+    if shared_images is not None:
+        train_dataset = ArrayDataset(shared_images)
+    else:
+        train_dataset = dataset_type(paths=train_paths, im_size=im_size, gray_scale=gray_scale, center_crop=center_crop)
     drop_last = (not limit_data) or (limit_data != batch_size)
     train_loader = DataLoader(train_dataset, batch_size=batch_size,
                               shuffle=True,
@@ -94,3 +160,113 @@ def get_dataloader(data_root, im_size, batch_size, n_workers, val_percentage=0,
                                  pin_memory=True, drop_last=drop_last)
 
     return train_loader, test_loader
+
+
+class InfiniteBatchSampler(Sampler):
+    """
+    Endless sequence of index batches: every epoch is a new permutation of the data seeded by (seed, epoch), split
+    between ranks and cut into full batches. Batch k of the sequence only depends on the seed and k so the sequence
+    can be restarted from any batch with 'start_batch'
+    """
+    def __init__(self, n, batch_size, seed=0, rank=0, world_size=1, start_batch=0):
+        self.n = n
+        self.batch_size = batch_size
+        self.seed = seed
+        self.rank = rank
+        self.world_size = world_size
+        self.start_batch = start_batch
+        self.batches_per_epoch = (n // world_size) // batch_size
+        if self.batches_per_epoch == 0:
+            raise ValueError(f"Batch size {batch_size} is larger than the {n // world_size} images of each rank")
+
+    def epoch_batches(self, epoch):
+        permutation = torch.randperm(self.n, generator=torch.Generator().manual_seed(self.seed + epoch))
+        shard = permutation[self.rank::self.world_size][:self.batches_per_epoch * self.batch_size]
+        return shard.view(self.batches_per_epoch, self.batch_size).tolist()
+
+    def get_batch_indices(self, k):
+        epoch, offset = divmod(k, self.batches_per_epoch)
+        return self.epoch_batches(epoch)[offset]
+
+    def __iter__(self):
+        epoch, offset = divmod(self.start_batch, self.batches_per_epoch)
+        while True:
+            yield from self.epoch_batches(epoch)[offset:]
+            epoch += 1
+            offset = 0
+
+
+class BatchStream:
+    """
+    Infinite iterator over batches of 'dataset' placed on 'device'. DataLoader workers are spawned once and a background
+    thread keeps up to 'prefetch' batches (pinned when training on GPU) ready while the training step runs.
+    'consumed' counts the batches returned so far; a stream created with start_batch=consumed continues where this one
+    stopped
+    """
+    def __init__(self, dataset, batch_size, n_workers, device, seed=0, prefetch=2, rank=0, world_size=1,
+                 start_batch=0, memory_format=torch.contiguous_format):
+        self.dataset = dataset
+        self.device = device
+        self.memory_format = memory_format
+        self.sampler = InfiniteBatchSampler(len(dataset), batch_size, seed, rank, world_size, start_batch)
+        self.consumed = start_batch
+        self.pin = device.type == 'cuda'
+        loader_kwargs = dict(num_workers=n_workers, persistent_workers=True, prefetch_factor=prefetch) if n_workers > 0 else dict()
+        # A dedicated generator seeds the workers: the global RNG is not touched from the prefetch thread
+        self.loader = DataLoader(dataset, batch_sampler=self.sampler, generator=torch.Generator().manual_seed(seed),
+                                 **loader_kwargs)
+
+        # Workers are forked here, from the main thread: forking from the prefetch thread while the main thread runs
+        # torch ops can deadlock the workers
+        self.iterator = iter(self.loader)
+
+        self.queue = queue.Queue(maxsize=max(1, prefetch))
+        self.stopped = threading.Event()
+        self.thread = threading.Thread(target=self._run, daemon=True)
+        self.thread.start()
+
+    def _run(self):
+        try:
+            for batch in self.iterator:
+                if self.pin:
+                    batch = batch.pin_memory()
+                if not self._put(batch):
+                    return
+        except Exception as e:
+            self._put(e)  # Raised in the training thread by __next__
+
+    def _put(self, item):
+        """Wait for room in the queue. Returns False if the stream was closed meanwhile"""
+        while not self.stopped.is_set():
+            try:
+                self.queue.put(item, timeout=0.1)
+                return True
+            except queue.Full:
+                pass
+        return False
+
+    def __iter__(self):
+        return self
+
+    def __next__(self):
+        while True:
+            try:
+                batch = self.queue.get(timeout=1)
+                break
+            except queue.Empty:
+                if not self.thread.is_alive() and self.queue.empty():
+                    raise RuntimeError("The batch prefetching thread stopped")
+        if isinstance(batch, Exception):
+            raise batch
+        self.consumed += 1
+        return batch.to(self.device, non_blocking=self.pin, memory_format=self.memory_format)
+
+    def get_batch(self, k):
+        """Load batch k of the stream in the calling process without moving the stream"""
+        batch = default_collate([self.dataset[i] for i in self.sampler.get_batch_indices(k)])
+        return batch.contiguous(memory_format=self.memory_format)
+
+    def close(self):
+        self.stopped.set()
+        self.thread.join()
+        del self.iterator  # Shuts down the persistent workers
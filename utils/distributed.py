@@ -0,0 +1,95 @@
+import os
+
+import torch
+import torch.distributed as dist
+
+
+def init_distributed(args):
+    """
+    Initialize torch.distributed when launched with torchrun (WORLD_SIZE > 1), e.g
+    torchrun --nproc_per_node 4 train.py --device cpu ...
+    Uses gloo on CPU and nccl on GPUs (one device per local rank). Returns (rank, world_size)
+    """
+    world_size = int(os.environ.get("WORLD_SIZE", 1))
+    if world_size == 1:
+        return 0, 1
+    if args.device == 'cpu':
+        dist.init_process_group("gloo")
+    else:
+        args.device = f"cuda:{int(os.environ['LOCAL_RANK'])}"
+        dist.init_process_group("nccl")
+    return dist.get_rank(), world_size
+
+
+def is_distributed():
+    return dist.is_available() and dist.is_initialized() and dist.get_world_size() > 1
+
+
+def is_main_process():
+    return not is_distributed() or dist.get_rank() == 0
+
+
+def unwrap(model):
+    """The underlying module of a DistributedDataParallel model"""
+    return model.module if isinstance(model, torch.nn.parallel.DistributedDataParallel) else model
+
+
+def broadcast_from_main(x, device):
+    """Return rank 0's version of the tensor x on all ranks"""
+    if not is_distributed():
+        return x
+    x_device = x.to(device)
+    dist.broadcast(x_device, src=0)
+    return x_device.to(x.device)
+
+
+def gather_batches(x):
+    """
+    Concatenate the batches of all ranks. Gradients flow back to each rank's own batch: all_gather's backward sums the
+    gradients computed by all ranks which, when every rank computes the same global loss, is world_size times its
+    gradient. DistributedDataParallel's gradient averaging divides it back
+    """
+    if not is_distributed():
+        return x
+    from torch.distributed.nn.functional import all_gather
+    return torch.cat(all_gather(x))
+
+
+class GlobalBatchLoss:
+    """Compute a minibatch loss (w1, swd, patch losses...) on the real and fake batches gathered from all ranks so that
+    distributed training optimizes the same global quantity as a single process with the full batch.
+    The loss' own randomness (swd projections, sampled patches...) is seeded from a generator shared by all ranks
+    ('seed' must be the same on all of them) while the ranks' global RNGs, which sample the noise, are left untouched"""
+    def __init__(self, loss, seed):
+        self.loss = loss
+        self.generator = torch.Generator().manual_seed(seed)
+
+    def trainG(self, netD, real_data, fake_data):
+        real_data, fake_data = gather_batches(real_data.detach()), gather_batches(fake_data)
+        loss_seed = int(torch.randint(2**62, (1,), generator=self.generator))
+        with torch.random.fork_rng(devices=[real_data.device] if real_data.device.type == 'cuda' else []):
+            torch.manual_seed(loss_seed)
+            return self.loss.trainG(netD, real_data, fake_data)
+
+    def __getattr__(self, name):
+        if name == 'loss':
+            raise AttributeError(name)
+        return getattr(self.loss, name)
+
+
+class NullLogger:
+    """Logger of non-main ranks"""
+    def log(self, data_dict, step):
+        pass
+
+    def plot(self):
+        pass
+
+    def state_dict(self):
+        return {}
+
+    def load_state_dict(self, state_dict):
+        pass
+
+    def close(self):
+        pass
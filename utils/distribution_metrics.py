@@ -1,48 +1,72 @@
+from functools import wraps
+from itertools import chain
+
 import numpy as np
 import ot
 import torch
 from tqdm import tqdm
 from utils.metrics import get_dist_metric, batch_NN
+from utils.pairwise_distances import pairwise_min, paired_distances
+from utils.profiling import span
+
 
+def float32(metric):
+    """Run a metric in float32 outside of autocast: OT plans, sorting and EMD are sensitive to reduced precision"""
+    @wraps(metric)
+    def wrapper(x, y, *args, **kwargs):
+        with torch.autocast(device_type=x.device.type, enabled=False):
+            return metric(x.float(), y.float(), *args, **kwargs)
+    return wrapper
 
+
+@float32
 def w1(x, y, epsilon=0, **kwargs):
     """Compute Optimal transport with L2 norm as base metric
         param x: (b1,d) shaped tensor
         param y: (b2,d) shaped tensor
     """
     base_metric = get_dist_metric("L2")
-    C = base_metric(x, y)
+    with span("cost_matrix"):
+        C = base_metric(x, y)
     OTPlan = _compute_ot_plan(C.detach().cpu().numpy(), int(epsilon))
     OTPlan = torch.from_numpy(OTPlan).to(C.device)
     W1 = torch.sum(OTPlan * C)
     return W1, {"W1-L2": W1}
 
 
+@float32
 def nn(x, y, alpha=None, **kwargs):
     """some over distances to nearest neighbor in the other set
+    The nearest neighbors are found with tiled min reductions and the gradient is routed through the selected pairs
         param x: (b1,d) shaped tensor
         param y: (b2,d) shaped tensor
     """
-    base_metric = get_dist_metric("L2")
-    C = base_metric(x, y)
+    col_scale = None
     if alpha is not None:
-        C = C / (C.min(dim=0)[0] + float(alpha))  # compute_normalized_scores
-    nn_loss = C.min(dim=1)[0].mean()
+        _, y_nns = pairwise_min(x, y, dim=0)
+        col_scale = paired_distances(x[y_nns], y) + float(alpha)  # compute_normalized_scores
+    _, x_nns = pairwise_min(x, y, dim=1, col_scale=None if col_scale is None else col_scale.detach())
+    nn_dists = paired_distances(x, y[x_nns])
+    if col_scale is not None:
+        nn_dists = nn_dists / col_scale[x_nns]
+    nn_loss = nn_dists.mean()
     return nn_loss, {"nn_loss": nn_loss}
 
 
+@float32
 def remd(x, y, **kwargs):
     """Releaxed EMD: Style transfer by re-laxed optimal transport and self-similarity
         This is basicly bidirectional NN loss
         param x: (b1,d) shaped tensor
         param y: (b2,d) shaped tensor
     """
-    base_metric = get_dist_metric("L2")
-    C = base_metric(x, y)
-    nn_loss = max(C.min(dim=0)[0].mean(), C.min(dim=1)[0].mean())
+    _, x_nns = pairwise_min(x, y, dim=1)
+    _, y_nns = pairwise_min(x, y, dim=0)
+    nn_loss = max(paired_distances(x[y_nns], y).mean(), paired_distances(x, y[x_nns]).mean())
     return nn_loss, {"remd_loss": nn_loss}
 
 
+@float32
 def projected_w1(x, y, epsilon=0, dim=64, num_proj=16, **kwargs):
     """Project points to 'dim' dimensions and compute OT there. Avearage over 'num_proj' such projections
         param x: (b1,d) shaped tensor
@@ -59,8 +83,9 @@ def projected_w1(x, y, epsilon=0, dim=64, num_proj=16, **kwargs):
         rand = rand / torch.norm(rand, dim=0, keepdim=True)  # noramlize to unit directions
 
         # Project images
-        projx = torch.mm(x, rand)
-        projy = torch.mm(y, rand)
+        with span("projection"):
+            projx = torch.mm(x, rand)
+            projy = torch.mm(y, rand)
 
         base_metric = get_dist_metric("L2")
         C = base_metric(projx, projy)
@@ -92,6 +117,24 @@ def projected_w1(x, y, epsilon=0, dim=64, num_proj=16, **kwargs):
     return W1, {"W1-L2": W1}
 
 
+def _random_projections(d, num_proj, device):
+    rand = torch.randn(d, num_proj).to(device)  # (slice_size**2*ch)
+    return rand / torch.norm(rand, dim=0, keepdim=True)  # noramlize to unit directions
+
+
+def _sliced_distance(projx, projy):
+    """Mean 1d OT distance between the columns of two projected sets"""
+    projx, projy = _duplicate_to_match_lengths(projx.T, projy.T)
+
+    # Sort and compute L1 loss
+    with span("sort"):
+        projx, _ = torch.sort(projx, dim=1)
+        projy, _ = torch.sort(projy, dim=1)
+
+    return (projx - projy).abs().mean() # This is same for L2 and L1 since in 1d: .pow(2).sum(1).sqrt() == .pow(2).sqrt() == .abs()
+
+
+@float32
 def swd(x, y, num_proj=128, **kwargs):
     """
     Project samples to 1d and compute OT there with the sorting trick. Average over num_proj directions
@@ -103,24 +146,42 @@ def swd(x, y, num_proj=128, **kwargs):
     _, d = x.shape
 
     # Sample random normalized projections
-    rand = torch.randn(d, num_proj).to(x.device)  # (slice_size**2*ch)
-    rand = rand / torch.norm(rand, dim=0, keepdim=True)  # noramlize to unit directions
+    rand = _random_projections(d, num_proj, x.device)
 
     # Project images
-    projx = torch.mm(x, rand)
-    projy = torch.mm(y, rand)
+    with span("projection"):
+        projx = torch.mm(x, rand)
+        projy = torch.mm(y, rand)
 
-    projx, projy = _duplicate_to_match_lengths(projx.T, projy.T)
+    SWD = _sliced_distance(projx, projy)
 
-    # Sort and compute L1 loss
-    projx, _ = torch.sort(projx, dim=1)
-    projy, _ = torch.sort(projy, dim=1)
+    return SWD, {"SWD": SWD}
+
+
+def streaming_swd(x_batches, y, num_proj=128, **kwargs):
+    """
+    swd between the concatenation of x_batches and y that only keeps the 1d projections of x's batches.
+    The projections are drawn after the first batch is produced: with a single (lazily generated) batch the random draws
+    are the same as those of swd(x, y) after generating x
+    param x_batches: iterable of (b_i,d) shaped tensors
+    param y: (b2,d) shaped tensor
+    """
+    num_proj = int(num_proj)
+    x_batches = iter(x_batches)
+    first_batch = next(x_batches)
+    with torch.autocast(device_type=y.device.type, enabled=False):
+        y = y.float()
+        rand = _random_projections(y.shape[1], num_proj, y.device)
+        with span("projection"):
+            projx = torch.cat([torch.mm(x.float().to(y.device), rand) for x in chain([first_batch], x_batches)])
+            projy = torch.mm(y, rand)
 
-    SWD = (projx - projy).abs().mean() # This is same for L2 and L1 since in 1d: .pow(2).sum(1).sqrt() == .pow(2).sqrt() == .abs()
+        SWD = _sliced_distance(projx, projy)
 
     return SWD, {"SWD": SWD}
 
 
+@float32
 def sinkhorn(x, y, epsilon=1, **kwargs):
     """Compute Sinkhorn on GPU with geomloss package"""
     from geomloss import SamplesLoss
@@ -129,6 +190,7 @@ def sinkhorn(x, y, epsilon=1, **kwargs):
     return SH, {"Sinkhorm-eps=1": SH}
 
 
+@float32
 def discrete_dual(x, y, n_steps=500, batch_size=None, lr=0.001, verbose=False, nnb=256, dist="L2"):
     """Solve the discrete dual OT problem with minibatches and SGD:
      Optimize n scalars (dual potentials) defining the dual formulation"""
@@ -165,14 +227,16 @@ def discrete_dual(x, y, n_steps=500, batch_size=None, lr=0.001, verbose=False, n
         return dual_estimate, {"dual": dual_estimate.item()}
 
 
+@torch.compiler.disable  # POT runs on numpy: break the graph instead of tracing it
 def _compute_ot_plan(C, epsilon=0):
     """Use POT to compute optimal transport between two emprical (uniforms) distriutaion with distance matrix C"""
     uniform_x = np.ones(C.shape[0]) / C.shape[0]
     uniform_y = np.ones(C.shape[1]) / C.shape[1]
-    if epsilon > 0:
-        OTplan = ot.sinkhorn(uniform_x, uniform_y, C, reg=epsilon)
-    else:
-        OTplan = ot.emd(uniform_x, uniform_y, C)
+    with span("emd"):
+        if epsilon > 0:
+            OTplan = ot.sinkhorn(uniform_x, uniform_y, C, reg=epsilon)
+        else:
+            OTplan = ot.emd(uniform_x, uniform_y, C)
     return OTplan
 
 
@@ -0,0 +1,65 @@
+from copy import deepcopy
+
+import torch
+from torch.func import stack_module_state, functional_call, vmap
+
+
+class GeneratorEnsemble:
+    """
+    M independent generators trained as one: their parameters are stacked along a new first dimension and all members
+    run in a single vmapped forward. Optimizers over the stacked parameters are M independent optimizers as long as they
+    are element-wise (Adam, SGD...)
+    """
+    def __init__(self, models):
+        self.members = models  # Only used to materialize single members
+        self.params, self.buffers = stack_module_state(models)
+        self.base = deepcopy(models[0]).to('meta')
+
+        def call_member(params, buffers, z):
+            return functional_call(self.base, (params, buffers), (z,))
+        self.forward = vmap(call_member)
+
+    def __len__(self):
+        return len(self.members)
+
+    def parameters(self):
+        return list(self.params.values())
+
+    def __call__(self, z):
+        """param z: (M, b, ...) shaped latents (one batch per member). Returns (M, b, c, h, w) images"""
+        return self.forward(self.params, self.buffers, z)
+
+    @torch.no_grad()
+    def member(self, m):
+        """The current state of the m'th generator as a regular module"""
+        model = self.members[m]
+        model.load_state_dict({name: value[m] for name, value in {**self.params, **self.buffers}.items()})
+        return model
+
+
+class EnsembleLoss:
+    """
+    Compute a discriminator-free loss (e.g MiniBatchLoss) of every member of an ensemble against the same real batch.
+    The members' losses are vmapped (each member draws its own random projections...) and computed in a loop if the
+    loss can't be vmapped (e.g OT solvers running outside of torch)
+    """
+    def __init__(self, loss_function):
+        self.loss_function = loss_function
+        self.vmapped = True
+
+    def member_loss(self, real_data, fake_data):
+        return self.loss_function.trainG(None, real_data, fake_data)
+
+    def __call__(self, real_data, fake_data):
+        """Returns the (M,) losses and a dict of (M,) debug values"""
+        if self.vmapped:
+            try:
+                return vmap(self.member_loss, in_dims=(None, 0), randomness='different')(real_data, fake_data)
+            except Exception as e:
+                print(f"Loss can't be vmapped, computing the members' losses in a loop: {e}")
+                self.vmapped = False
+
+        results = [self.member_loss(real_data, fake) for fake in fake_data]
+        losses = torch.stack([loss for loss, _ in results])
+        debug_dict = {k: torch.stack([debug[k] for _, debug in results]) for k in results[0][1]}
+        return losses, debug_dict
@@ -0,0 +1,86 @@
+import queue
+from copy import copy, deepcopy
+
+import torch
+import torch.multiprocessing as mp
+
+from utils.checkpoint import to_cpu
+
+
+class _CollectingLogger:
+    def __init__(self):
+        self.logs = []
+
+    def log(self, data_dict, step):
+        self.logs.append((step, {k: float(v) for k, v in data_dict.items()}))
+
+
+def _worker_loop(evaluate_fn, netG, n_threads, jobs, results, eval_kwargs):
+    torch.set_num_threads(n_threads)
+    while True:
+        job = jobs.get()
+        if job is None:
+            break
+        iteration, state_dict = job
+        netG.load_state_dict(state_dict)
+        logger = _CollectingLogger()
+        evaluate_fn(netG=netG, iteration=iteration, logger=logger, **eval_kwargs)
+        results.put(logger.logs)
+
+
+class EvaluationWorker:
+    """
+    Run 'evaluate_fn' on CPU snapshots of the generator in a separate process with its own thread budget so that
+    evaluation does not stall training. evaluate_fn is called with netG, iteration, logger and 'eval_kwargs'
+    and the values it logs are sent back to the training logger by 'poll'
+    """
+    def __init__(self, evaluate_fn, netG, n_threads=1, **eval_kwargs):
+        netG = deepcopy(netG).cpu()
+        netG.__dict__.pop('forward', None)  # Compiled forwards can't be sent to the worker
+        if eval_kwargs.get('prior') is not None:  # The worker evaluates on CPU: it gets a CPU copy of the latents
+            eval_kwargs['prior'] = copy(eval_kwargs['prior'])
+            eval_kwargs['prior'].z = to_cpu(eval_kwargs['prior'].z)
+        ctx = mp.get_context('spawn')
+        self.jobs = ctx.Queue(maxsize=1)
+        self.results = ctx.Queue()
+        self.process = ctx.Process(target=_worker_loop, daemon=True,
+                                   args=(evaluate_fn, netG, n_threads, self.jobs, self.results, eval_kwargs))
+        self.process.start()
+
+    def submit(self, netG, iteration, wait=False):
+        """Queue the evaluation of a snapshot of netG. It is skipped if the worker is busy unless 'wait' is set (e.g for
+        the final state), in which case this blocks until the worker takes the job or dies"""
+        job = (iteration, to_cpu(netG.state_dict()))
+        while wait and self.process.is_alive():
+            try:
+                self.jobs.put(job, timeout=1)
+                return
+            except queue.Full:
+                pass
+        try:
+            self.jobs.put_nowait(job)
+        except queue.Full:
+            print(f"Evaluation worker is busy: skipping evaluation of iteration {iteration}")
+
+    def poll(self, logger):
+        """Log the results of all finished evaluations"""
+        while True:
+            try:
+                logs = self.results.get_nowait()
+            except queue.Empty:
+                return
+            for step, data_dict in logs:
+                logger.log(data_dict, step=step)
+
+    def close(self, logger, timeout=600):
+        """Wait up to 'timeout' seconds for the pending evaluation, then stop the worker and log its results"""
+        if self.process.is_alive():
+            try:
+                self.jobs.put(None, timeout=timeout)
+            except queue.Full:
+                print("Evaluation worker is not responding")
+            self.process.join(timeout)
+        if self.process.is_alive():
+            self.process.terminate()
+            self.process.join()
+        self.poll(logger)
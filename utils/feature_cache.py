@@ -0,0 +1,37 @@
+import hashlib
+import os
+
+import torch
+
+
+def extract_features_in_batches(X, f, b=64):
+    """Run the feature extractor f on X in batches of size 'b' and gather the flattened features on the CPU"""
+    with torch.no_grad():
+        features = [f(X[i:i + b]).reshape(len(X[i:i + b]), -1).cpu() for i in range(0, len(X), b)]
+    return torch.cat(features)
+
+
+class FeatureCache:
+    """
+    Keeps deep features of fixed image sets (e.g the real data) in memory and on disk so that repeated evaluations
+    only need to extract the features of the generated images.
+    Features are keyed by (extractor name, dataset id): the name must identify the extractor weights, layers and input
+    preprocessing and the dataset id the images (e.g data path, image size, crop...) so that stale features are never reused
+    """
+    def __init__(self, cache_dir=os.path.join("outputs", "feature_cache")):
+        self.cache_dir = cache_dir
+        self.features = dict()
+
+    def get(self, name, dataset_id, extract):
+        """The features of 'dataset_id' by the extractor 'name', computed with extract() if they are not cached"""
+        key = hashlib.sha1(str((name, dataset_id)).encode()).hexdigest()[:16]
+        if key not in self.features:
+            path = os.path.join(self.cache_dir, f"{key}.pt")
+            if os.path.exists(path):
+                self.features[key] = torch.load(path)
+            else:
+                self.features[key] = extract()
+                os.makedirs(self.cache_dir, exist_ok=True)
+                torch.save(self.features[key], path + ".tmp")
+                os.replace(path + ".tmp", path)
+        return self.features[key]
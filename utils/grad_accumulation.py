@@ -0,0 +1,73 @@
+from contextlib import nullcontext
+
+import torch
+
+from utils.train_utils import get_interpolates, penalize_gradients
+
+
+def generate_in_chunks(netG, noise, micro_bs):
+    """Generate images without gradients in micro batches"""
+    with torch.no_grad():
+        return torch.cat([netG(z) for z in torch.split(noise, micro_bs)])
+
+
+def accumulate_D_step(loss_function, netD, real_data, fake_data, micro_bs, gp_weight=0, scaler=None,
+                      autocast=nullcontext):
+    """
+    Accumulate the gradients of a WGAN(-GP) critic loss over micro batches of real/fake samples.
+    All terms are means over samples so each micro batch is weighted by its share of the full batch and the accumulated
+    gradients match the full batch ones (netD must not have batch norm, train.py refuses --micro_bs with it)
+    """
+    assert getattr(loss_function, 'per_sample_loss', False), "Only per-sample losses can be accumulated for D"
+    fake_data = fake_data.detach()
+    WD = 0
+    for sign, data in [(1, real_data), (-1, fake_data)]:
+        for chunk in torch.split(data, micro_bs):
+            with autocast():
+                score = sign * netD(chunk).float().sum() / len(data)
+            scaler.scale(-score).backward()  # Maximize term to get WD
+            WD = WD + score.detach()
+    debug_dict = {"W1": WD}
+
+    if gp_weight > 0:
+        alpha = torch.rand(1, 1)  # A single interpolation weight is shared by all micro batches
+        gradient_norm = 0
+        for real_chunk, fake_chunk in zip(torch.split(real_data, micro_bs), torch.split(fake_data, micro_bs)):
+            with autocast():
+                interpolates = get_interpolates(real_chunk, fake_chunk, alpha)
+                gp, chunk_gradient_norm = penalize_gradients(netD(interpolates), interpolates, scaler=scaler)
+            scaler.scale(gp_weight * gp * len(real_chunk) / len(real_data)).backward()
+            gradient_norm = gradient_norm + chunk_gradient_norm * len(real_chunk) / len(real_data)
+        debug_dict['gradient_norm'] = gradient_norm
+        debug_dict['normalized W1'] = torch.where(gradient_norm > 0, WD / gradient_norm, torch.zeros_like(gradient_norm))
+
+    return debug_dict
+
+
+def accumulate_G_step(loss_function, netG, netD, real_data, noise, micro_bs, scaler=None, autocast=nullcontext):
+    """
+    Accumulate the generator gradients over micro batches of the noise.
+    Per-sample losses (WGAN) are weighted by each micro batch share. Losses that need the whole batch (e.g w1/swd) use
+    two phases: the loss and its gradient w.r.t all the generated images are computed once (this is where the global
+    transport assignment is solved) and this gradient is then backpropagated through netG micro batch by micro batch
+    """
+    noise_chunks = torch.split(noise, micro_bs)
+    if getattr(loss_function, 'per_sample_loss', False):
+        Gloss = 0
+        for z in noise_chunks:
+            with autocast():
+                chunk_loss, _ = loss_function.trainG(netD, real_data, netG(z))
+                chunk_loss = chunk_loss * len(z) / len(noise)
+            scaler.scale(chunk_loss).backward()
+            Gloss = Gloss + chunk_loss.detach()
+        return {"Gloss": Gloss}
+
+    with autocast():
+        fake_data = generate_in_chunks(netG, noise, micro_bs).requires_grad_(True)
+        Gloss, debug_dict = loss_function.trainG(netD, real_data, fake_data)
+    fake_grad = torch.autograd.grad(scaler.scale(Gloss), fake_data)[0]
+    for z, grad_chunk in zip(noise_chunks, torch.split(fake_grad, micro_bs)):
+        with autocast():
+            fake_chunk = netG(z)
+        fake_chunk.backward(grad_chunk.to(fake_chunk.dtype))
+    return debug_dict
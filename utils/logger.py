@@ -1,10 +1,12 @@
 import os
 import pickle
 from collections import defaultdict
+from concurrent.futures import ThreadPoolExecutor
 
 import numpy as np
+import torch
 
-from matplotlib import pyplot as plt
+from matplotlib.figure import Figure
 import json
 import matplotlib as mpl
 
@@ -12,49 +14,136 @@ import wandb
 
 mpl.use('Agg')
 
+class MetricsAccumulator:
+    """Buffer logged values without synchronizing: tensors stay on their device until a window is reduced"""
+    def __init__(self):
+        self.buffers = defaultdict(list)
+
+    def add(self, data_dict):
+        for k, v in data_dict.items():
+            self.buffers[k].append(v.detach().float().reshape(()) if torch.is_tensor(v) else torch.tensor(float(v)))
+
+    def reduce(self):
+        """Reduce every buffer to (mean, std, last value) with a single device to host copy per key and clear it"""
+        stats = dict()
+        for k, values in self.buffers.items():
+            if values:
+                device = values[-1].device
+                values = torch.stack([v.to(device) for v in values])
+                stats[k] = torch.stack([values.mean(), values.std(unbiased=False), values[-1]]).tolist()
+        self.buffers = defaultdict(list)
+        return stats
+
+
 class PLTLogger:
+    """
+    Accumulate logged values in windows (between calls to 'plot'). Every window is appended as a single json line to
+    'history.jsonl' and the plots (and '{k}.pkl' window averages) of the updated keys are written by a background thread
+    """
     def __init__(self, args, save_dir):
         self.save_dir = save_dir
         os.makedirs(save_dir, exist_ok=True)
         self.data_avgs = defaultdict(list)
         self.data_stds = defaultdict(list)
-        self.data = defaultdict(list)
+        self.accumulator = MetricsAccumulator()
+        self.last_step = 0
+        self.history_path = os.path.join(save_dir, "history.jsonl")
+        self.writer = ThreadPoolExecutor(max_workers=1)
 
     def log(self, data_dict, step):
-        for k, v in data_dict.items():
-            self.data[k].append(float(v))
+        self.accumulator.add(data_dict)
+        self.last_step = step
 
     def plot(self):
-        # Plot single plots
-        for k, v in self.data.items():
-            if self.data[k]:
-                last_value = self.data[k][-1]
-                self.data_stds[k] += [np.std(self.data[k])]
-                self.data_avgs[k] += [np.mean(self.data[k])]
-                self.data[k] = []
-                x = np.arange(len(self.data_avgs[k]))
-                plt.plot(x, self.data_avgs[k], label=k, color='b', alpha=0.75)
-                vals = np.array(self.data_avgs[k])
-                stds = np.array(self.data_stds[k])
-                plt.fill_between(x, vals - stds / 2, vals + stds / 2, alpha=0.15, color='b')
-
-                plt.title(k + f"\n Last value: {last_value:.5f}")
-                plt.savefig(self.save_dir + f"/{k}.png")
-                plt.clf()
-
-            f = open(f'{self.save_dir}/{k}.pkl', 'wb')
-            pickle.dump(self.data_avgs[k], f)
+        stats = self.accumulator.reduce()
+        if not stats:
+            return
+        plots = dict()
+        for k, (avg, std, last_value) in stats.items():
+            self.data_avgs[k] += [avg]
+            self.data_stds[k] += [std]
+            plots[k] = (list(self.data_avgs[k]), list(self.data_stds[k]), last_value)
+        self.writer.submit(self._write_window, self.last_step, stats, plots)
+
+    def state_dict(self):
+        return {"data_avgs": {k: list(v) for k, v in self.data_avgs.items()},
+                "data_stds": {k: list(v) for k, v in self.data_stds.items()}, "last_step": self.last_step}
+
+    def load_state_dict(self, state_dict):
+        """Restore the plotted windows and drop the history written after the checkpoint"""
+        self.data_avgs = defaultdict(list, state_dict["data_avgs"])
+        self.data_stds = defaultdict(list, state_dict["data_stds"])
+        self.last_step = state_dict["last_step"]
+        if os.path.exists(self.history_path):
+            with open(self.history_path) as f:
+                lines = [line for line in f if line.strip() and json.loads(line)["step"] <= self.last_step]
+            with open(self.history_path + ".tmp", 'w') as f:
+                f.writelines(lines)
+            os.replace(self.history_path + ".tmp", self.history_path)
+
+    def _write_window(self, step, stats, plots):
+        with open(self.history_path, 'a') as f:
+            f.write(json.dumps({"step": step, "values": stats}) + "\n")
+
+        for k, (avgs, stds, last_value) in plots.items():
+            fig = Figure()
+            ax = fig.add_subplot()
+            x = np.arange(len(avgs))
+            ax.plot(x, avgs, label=k, color='b', alpha=0.75)
+            vals = np.array(avgs)
+            stds = np.array(stds)
+            ax.fill_between(x, vals - stds / 2, vals + stds / 2, alpha=0.15, color='b')
+
+            ax.set_title(k + f"\n Last value: {last_value:.5f}")
+            fig.savefig(self.save_dir + f"/{k}.png")
+
+            with open(f'{self.save_dir}/{k}.pkl', 'wb') as f:
+                pickle.dump(avgs, f)
+
+    def close(self):
+        self.plot()
+        self.writer.shutdown(wait=True)
 
 
 class WandbLogger:
+    """
+    Log the value of every step. Values are buffered on their device and sent at every 'plot' with a single device to
+    host copy. wandb steps must increase: values of already sent steps (e.g results of the evaluation worker) are logged
+    at the last sent step
+    """
     def __init__(self, args, save_dir):
         self.wandb = wandb.init(project=args.project_name, dir=save_dir, name=args.train_name)
+        self.pending = []
+        self.last_step = 0
+        self.sent_step = 0
 
     def log(self, val_dict, step):
-        self.wandb.log(val_dict, step=step)
+        self.pending.append((step, {k: v.detach().float().reshape(()) if torch.is_tensor(v) else torch.tensor(float(v))
+                                    for k, v in val_dict.items()}))
+        self.last_step = step
 
     def plot(self):
-        pass
+        values = [v for _, data_dict in self.pending for v in data_dict.values()]
+        if not values:
+            return
+        device = values[-1].device
+        host_values = iter(torch.stack([v.to(device) for v in values]).tolist())
+        steps = defaultdict(dict)
+        for step, data_dict in self.pending:
+            steps[max(step, self.sent_step)].update({k: next(host_values) for k in data_dict})
+        for step in sorted(steps):
+            self.wandb.log(steps[step], step=step)
+        self.sent_step = max(steps)
+        self.pending = []
+
+    def state_dict(self):
+        return {"last_step": self.last_step}
+
+    def load_state_dict(self, state_dict):
+        self.last_step = state_dict["last_step"]
+
+    def close(self):
+        self.plot()
 
 def get_dir(args):
     task_name = os.path.join(f"outputs", args.project_name,   args.train_name)
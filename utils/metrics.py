@@ -1,36 +1,50 @@
+import os
+
 import torch
 
+from utils.feature_cache import extract_features_in_batches
+from utils.pairwise_distances import pairwise_distances
+
 
-def get_dist_metric(name):
+def get_dist_metric(name, **kwargs):
     """Choose how to calulate pairwise distances for EMD"""
     if name == 'L1':
-        metric = L1()
+        metric = L1(**kwargs)
     elif name == 'L2':
-        metric = L2()
+        metric = L2(**kwargs)
     elif name == 'vgg':
-         metric = vgg_dist_calculator()
+         metric = vgg_dist_calculator(**kwargs)
     elif name == 'inception':
-        metric = inception_dist_calculator()
+        metric = inception_dist_calculator(**kwargs)
     else:
         raise ValueError(f"No such metric name {name}")
     return metric
 
 
 class L1:
+    """
+    Distances between all vectors in X and Y, i.e abs(X[:, None] - Y[None, :]).sum(-1), computed in blocks
+    so that the broadcasted difference never exceeds 'max_bytes'
+    """
+    def __init__(self, max_bytes=None):
+        self.max_bytes = max_bytes
+
     def __call__(self, X, Y):
-        assert len(X.shape) == len(Y.shape) == 2
-        return torch.abs(X[:, None] - Y[None, :]).sum(-1)
+        return pairwise_distances(X, Y, p=1, max_bytes=self.max_bytes)
 
 
 class L2:
     """
     Pytorch efficient way of computing distances between all vectors in X and Y, i.e sqrt((X[:, None] - Y[None, :])**2)
     """
+    def __init__(self, squared=False, max_bytes=None, matmul_dtype=None):
+        self.squared = squared
+        self.max_bytes = max_bytes
+        self.matmul_dtype = matmul_dtype
+
     def __call__(self, X, Y):
-        assert len(X.shape) == len(Y.shape) == 2
-        dist = (X * X).sum(1)[:, None] + (Y * Y).sum(1)[None, :] - 2.0 * torch.mm(X, torch.transpose(Y, 0, 1))
-        dist = torch.sqrt(torch.clamp(dist, min=1e-10)) # When loss is 0 the gradient of sqrt is nan
-        return dist
+        return pairwise_distances(X, Y, p=2, squared=self.squared, max_bytes=self.max_bytes,
+                                  matmul_dtype=self.matmul_dtype)
 
 
 def get_batche_slices(n, b):
@@ -44,38 +58,24 @@ def get_batche_slices(n, b):
     return slices
 
 
-def compute_features_dist_mat_in_batches(X, Y, f, b=64):
-    """Compute distance matrix in features of a function f(X) but restrict maximum inference batch to 'b'"""
-    X = X.cpu()
-    Y = Y.cpu()
-    dists = -1 * torch.ones(len(X), len(Y))
-    x_slices = get_batche_slices(len(X), b)
-    y_slices = get_batche_slices(len(Y), b)
-    all_features_x = [f(X[slice_x]) for slice_x in x_slices]
-    all_features_y = [f(Y[slice_y]) for slice_y in y_slices]
-
-    for slice_x, features_x in zip(x_slices, all_features_x):
-        for slice_y, features_y in zip(y_slices, all_features_y):
-            D = features_x[:, None] - features_y[None,]
-            D = D.reshape(D.shape[0], D.shape[1], -1) # In case features are still spatial
-            dists[slice_x, slice_y] = torch.norm(D, dim=-1)
-
-    # for slice_x in x_slices:
-    #     features_x = f(X[slice_x])
-    #     for slice_y in y_slices:
-    #         features_y = f(Y[slice_y])
-    #         D = features_x[:, None] - features_y[None,]
-    #         D = D.reshape(D.shape[0], D.shape[1], -1) # In case featueres are still spatial
-    #         dists[slice_x, slice_y] = torch.norm(D, dim=-1)
-    return dists
+def compute_features_dist_mat_in_batches(X, Y, f, b=64, Y_features=None):
+    """Compute distance matrix in features of a function f(X) but restrict maximum inference batch to 'b'
+    Y_features can be passed (e.g from a FeatureCache) to skip extracting the features of Y"""
+    features_x = extract_features_in_batches(X, f, b)
+    features_y = extract_features_in_batches(Y, f, b) if Y_features is None else Y_features
+    return pairwise_distances(features_x, features_y)  # features are flattened in case they are still spatial
 
 
 class inception_dist_calculator:
-    def __init__(self, device=None):
+    """Y is treated as the fixed reference set: with a 'cache' (a FeatureCache) and a Y_id its features are cached"""
+    def __init__(self, device=None, cache=None):
         from benchmarking.inception import myInceptionV3
         self.device = device
+        self.cache = cache
         self.inception = myInceptionV3()
         self.inception.eval()
+        weights_path = self.inception.weights_path
+        self.name = f"inceptionV3-{weights_path}-{os.path.getmtime(weights_path)}-pool-inputs[-1,1]"
 
     def extract(self, X):
         X = X.to(self.device)
@@ -85,48 +85,88 @@ class inception_dist_calculator:
             self.inception.to(self.device)
         return self.inception(X)
 
-    def __call__(self, X, Y, b=64):
-        return compute_features_dist_mat_in_batches(X, Y, self.extract, b=b)
+    def __call__(self, X, Y, b=64, Y_id=None):
+        Y_features = None
+        if self.cache is not None and Y_id is not None:
+            Y_features = self.cache.get(self.name, Y_id, lambda: extract_features_in_batches(Y, self.extract, b))
+        return compute_features_dist_mat_in_batches(X, Y, self.extract, b=b, Y_features=Y_features)
 
 
 class vgg_dist_calculator:
-    def __init__(self,  layer_idx=18, device=None):
+    """Y is treated as the fixed reference set: with a 'cache' (a FeatureCache) and a Y_id its features are cached"""
+    def __init__(self,  layer_idx=18, device=None, cache=None):
         self.layer_idx = layer_idx  # [4, 9, 18]
         from torchvision import models, transforms
         self.vgg_features = models.vgg19(weights=models.VGG19_Weights.IMAGENET1K_V1).features
         self.device = device
+        self.cache = cache
         self.vgg_features.eval()
+        self.vgg_features.requires_grad_(False)
         self.normalize = transforms.Normalize(mean=[0.485, 0.456, 0.406], std=[0.229, 0.224, 0.225])
 
+    @property
+    def name(self):
+        return f"vgg19-IMAGENET1K_V1-unnormalized_inputs-{self.layer_idx}"
+
     def extract(self, X, layer_idx=None):
         if layer_idx is None:
             layer_idx = self.layer_idx
+        return self.extract_layers(X, [layer_idx])[layer_idx]
+
+    def extract_layers(self, X, layer_indices, b=None, grad=False):
+        """
+        Collect the outputs of all layers in 'layer_indices' with forward hooks in a single forward pass that stops
+        at the deepest requested layer. X is processed in batches of size 'b' without gradients unless 'grad' is set
+        return a dict mapping each layer index to a (len(X), c, h, w) tensor
+        """
         if self.device is None:
             self.device = X.device
             self.vgg_features = self.vgg_features.to(self.device)
-        X = X.to(self.device)
-        for i, layer in enumerate(self.vgg_features):
-            X = layer(X)
-            # if i in layer_indices:
-            if i == layer_idx:
-                return X
-
-    def __call__(self, X, Y, b=64):
-        return compute_features_dist_mat_in_batches(X, Y, self.extract, b=b)
-
-
-def batch_dist_matrix(X, Y, b, dist_function):
+        layer_indices = sorted(set(int(i) for i in layer_indices))
+        truncated_features = self.vgg_features[:layer_indices[-1] + 1]
+        if b is None:
+            b = len(X)
+
+        current_outputs = dict()
+
+        def get_hook(i):
+            # The next layer may be an in-place ReLU that would override the stored output
+            clone = i + 1 < len(truncated_features) and getattr(truncated_features[i + 1], 'inplace', False)
+
+            def hook(module, input, output):
+                current_outputs[i] = output.clone() if clone else output
+            return hook
+
+        hooks = [self.vgg_features[i].register_forward_hook(get_hook(i)) for i in layer_indices]
+        outputs = {i: [] for i in layer_indices}
+        try:
+            with torch.enable_grad() if grad else torch.no_grad():  # Inference tensors can't be saved for backward
+                for i in range(0, len(X), b):
+                    truncated_features(X[i:i + b].to(self.device))
+                    for layer_idx in layer_indices:
+                        outputs[layer_idx].append(current_outputs[layer_idx])
+        finally:
+            for hook in hooks:
+                hook.remove()
+
+        return {i: torch.cat(outputs[i]) for i in layer_indices}
+
+    def __call__(self, X, Y, b=64, Y_id=None):
+        Y_features = None
+        if self.cache is not None and Y_id is not None:
+            Y_features = self.cache.get(self.name, Y_id, lambda: extract_features_in_batches(Y, self.extract, b))
+        return compute_features_dist_mat_in_batches(X, Y, self.extract, b=b, Y_features=Y_features)
+
+
+def batch_dist_matrix(X, Y, b, dist_function=None):
     """
-    For each x find the best index i s.t i = argmin_i(x,y_i)-f_i
-    return the value and the argmin
+    Compute the distance matrix between X and Y in batches of b rows of X and gather it on the CPU
+    (dist_function defaults to a blocked L2)
     """
+    if dist_function is None:
+        dist_function = L2()
     dists = torch.ones(len(X), len(Y))
-    n_batches = len(X) // b
-    for i in range(n_batches):
-        s = slice(i * b,(i + 1) * b)
-        dists[s] = dist_function(X[s], Y).cpu()
-    if len(X) % b != 0:
-        s = slice(n_batches * b, len(X))
+    for s in get_batche_slices(len(X), b):
         dists[s] = dist_function(X[s], Y).cpu()
 
     return dists
@@ -0,0 +1,123 @@
+import torch
+from torch.utils.checkpoint import checkpoint
+
+# Upper bound on the size (in bytes) of the intermediate tensors created while computing a single block of distances
+DEFAULT_MAX_BYTES = 2**28
+
+
+def get_block_sizes(n_rows, n_cols, dim, p=2, element_size=4, max_bytes=None):
+    """Choose (rows, cols) block sizes such that the intermediate tensor of a block fits in 'max_bytes':
+    L1 broadcasts a (rows, cols, dim) difference tensor while L2 only materializes a (rows, cols) matrix"""
+    if max_bytes is None:
+        max_bytes = DEFAULT_MAX_BYTES
+    bytes_per_pair = element_size * (dim if p == 1 else 1)
+    n_pairs = max(1, int(max_bytes) // bytes_per_pair)
+    cols = max(1, min(n_cols, n_pairs))
+    rows = max(1, min(n_rows, n_pairs // cols))
+    return rows, cols
+
+
+def _l1_block(x, y):
+    return torch.abs(x[:, None] - y[None, :]).sum(-1)
+
+
+def _l2_block(x, y, xx, yy, squared=False, matmul_dtype=None, eps=1e-10):
+    if matmul_dtype is not None:
+        xy = torch.mm(x.to(matmul_dtype), y.to(matmul_dtype).T).to(x.dtype)
+    else:
+        xy = torch.mm(x, y.T)
+    dist = xx[:, None] + yy[None, :] - 2.0 * xy
+    if squared:
+        return torch.clamp(dist, min=0)
+    return torch.sqrt(torch.clamp(dist, min=eps))  # When loss is 0 the gradient of sqrt is nan
+
+
+def iterate_distance_blocks(X, Y, p=2, squared=False, max_bytes=None, matmul_dtype=None, eps=1e-10):
+    """Yield (row_slice, col_slice, block) for blocks covering the (b1, b2) matrix of L1/L2 distances between rows of X and Y
+        param X: (b1,d) shaped tensor
+        param Y: (b2,d) shaped tensor
+        param p: 1 for L1 distances, 2 for L2 distances
+        param squared: (L2 only) return clamped squared distances instead of their sqrt
+        param max_bytes: budget for the intermediate tensors of a single block (defaults to DEFAULT_MAX_BYTES)
+        param matmul_dtype: (L2 only) run the cross term matmul in reduced precision (e.g torch.bfloat16)
+    """
+    assert len(X.shape) == len(Y.shape) == 2 and X.shape[1] == Y.shape[1]
+    if p not in (1, 2):
+        raise ValueError(f"Only L1 and L2 distances are supported, got p={p}")
+    rows, cols = get_block_sizes(len(X), len(Y), X.shape[1], p, X.element_size(), max_bytes)
+    # Autograd would keep the (rows, cols, d) differences of every L1 block alive for backward: checkpointed blocks only
+    # keep their inputs and recompute the differences block by block in backward so the budget holds with gradients too
+    checkpointed = p == 1 and torch.is_grad_enabled() and (X.requires_grad or Y.requires_grad)
+    if p == 2:
+        xx = (X * X).sum(1)
+        yy = (Y * Y).sum(1)
+
+    for i in range(0, len(X), rows):
+        row_slice = slice(i, min(i + rows, len(X)))
+        for j in range(0, len(Y), cols):
+            col_slice = slice(j, min(j + cols, len(Y)))
+            if checkpointed:
+                block = checkpoint(_l1_block, X[row_slice], Y[col_slice], use_reentrant=False)
+            elif p == 1:
+                block = _l1_block(X[row_slice], Y[col_slice])
+            else:
+                block = _l2_block(X[row_slice], Y[col_slice], xx[row_slice], yy[col_slice], squared, matmul_dtype, eps)
+            yield row_slice, col_slice, block
+
+
+def pairwise_distances(X, Y, p=2, squared=False, max_bytes=None, matmul_dtype=None, eps=1e-10, out_device=None):
+    """Compute the (b1, b2) matrix of L1/L2 distances between rows of X and Y block by block (see iterate_distance_blocks).
+    When no gradient is needed the blocks are written into a preallocated matrix on 'out_device' (defaults to X.device)
+    """
+    needs_grad = torch.is_grad_enabled() and (X.requires_grad or Y.requires_grad)
+    blocks = iterate_distance_blocks(X, Y, p, squared, max_bytes, matmul_dtype, eps)
+    if needs_grad:
+        rows = []
+        row_blocks = []
+        last_row = None
+        for row_slice, _, block in blocks:
+            if last_row is not None and row_slice != last_row:
+                rows.append(torch.cat(row_blocks, dim=1))
+                row_blocks = []
+            row_blocks.append(block)
+            last_row = row_slice
+        rows.append(torch.cat(row_blocks, dim=1))
+        dists = torch.cat(rows, dim=0)
+        return dists if out_device is None else dists.to(out_device)
+
+    dists = torch.empty(len(X), len(Y), dtype=X.dtype, device=X.device if out_device is None else out_device)
+    for row_slice, col_slice, block in blocks:
+        dists[row_slice, col_slice] = block
+    return dists
+
+
+def paired_distances(X, Y, p=2, squared=False, eps=1e-10):
+    """Distances between matching rows of X and Y (b,d) with the same clamping semantics as pairwise_distances"""
+    diff = X - Y
+    if p == 1:
+        return diff.abs().sum(1)
+    dist = (diff * diff).sum(1)
+    if squared:
+        return dist
+    return torch.sqrt(torch.clamp(dist, min=eps))
+
+
+def pairwise_min(X, Y, dim=1, p=2, col_scale=None, max_bytes=None, matmul_dtype=None):
+    """Tiled min reduction of the distance matrix between X and Y keeping only running minimums and argmins:
+    dim=1 finds the nearest y for every x and dim=0 the nearest x for every y. Memory is O(b1+b2) instead of O(b1*b2)
+        param col_scale: optional (b2,) tensor dividing the columns of the distance matrix before the reduction
+    return the (non differentiable) minimal values and their indices
+    """
+    n = len(X) if dim == 1 else len(Y)
+    min_vals = torch.full((n,), float('inf'), dtype=X.dtype, device=X.device)
+    min_idx = torch.zeros(n, dtype=torch.long, device=X.device)
+    with torch.no_grad():
+        for row_slice, col_slice, block in iterate_distance_blocks(X, Y, p, max_bytes=max_bytes, matmul_dtype=matmul_dtype):
+            if col_scale is not None:
+                block = block / col_scale[None, col_slice]
+            block_vals, block_idx = block.min(dim)
+            own_slice, other_slice = (row_slice, col_slice) if dim == 1 else (col_slice, row_slice)
+            improved = block_vals < min_vals[own_slice]
+            min_vals[own_slice] = torch.where(improved, block_vals, min_vals[own_slice])
+            min_idx[own_slice] = torch.where(improved, block_idx + other_slice.start, min_idx[own_slice])
+    return min_vals, min_idx
@@ -0,0 +1,73 @@
+import os
+import time
+from collections import defaultdict
+from contextlib import contextmanager, nullcontext
+
+import torch
+
+
+class SpanTimer:
+    """Accumulate the wall-clock durations of named spans of code. Spans are also labeled in torch.profiler traces"""
+    def __init__(self):
+        self.enabled = False
+        self.synchronize = False  # Wait for CUDA kernels at the end of each span for meaningful timings
+        self.durations = defaultdict(list)
+
+    @contextmanager
+    def span(self, name):
+        with torch.profiler.record_function(name):
+            start = time.perf_counter()
+            try:
+                yield
+            finally:
+                if self.synchronize:
+                    torch.cuda.synchronize()
+                self.durations[name].append(time.perf_counter() - start)
+
+    def record(self, name, seconds):
+        if self.enabled:
+            self.durations[name].append(seconds)
+
+    def summary(self):
+        """Mean and total duration of each span since the last summary"""
+        stats = dict()
+        for name, durations in self.durations.items():
+            stats[f"time/{name}-mean(ms)"] = 1000 * sum(durations) / len(durations)
+            stats[f"time/{name}-total(s)"] = sum(durations)
+        self.durations = defaultdict(list)
+        return stats
+
+
+timer = SpanTimer()
+
+
+def span(name):
+    """Time a named span of code with the global timer (a no-op unless timer.enabled)"""
+    return timer.span(name) if timer.enabled else nullcontext()
+
+
+class TraceWindow:
+    """Record a torch.profiler trace for iterations in [start, end) and export it as a Chrome trace to 'path'"""
+    def __init__(self, start, end, path):
+        self.start = start
+        self.end = end
+        self.path = path
+        self.profiler = None
+
+    def step(self, iteration):
+        if iteration == self.start:
+            activities = [torch.profiler.ProfilerActivity.CPU]
+            if torch.cuda.is_available():
+                activities.append(torch.profiler.ProfilerActivity.CUDA)
+            self.profiler = torch.profiler.profile(activities=activities, record_shapes=True)
+            self.profiler.__enter__()
+        elif iteration == self.end and self.profiler is not None:
+            self.close()
+
+    def close(self):
+        if self.profiler is not None:
+            self.profiler.__exit__(None, None, None)
+            os.makedirs(os.path.dirname(self.path), exist_ok=True)
+            self.profiler.export_chrome_trace(self.path)
+            print(f"Chrome trace written to {self.path}")
+            self.profiler = None
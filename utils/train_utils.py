@@ -1,11 +1,17 @@
 import argparse
 import glob
 import os
+import random
 from copy import deepcopy
+from functools import wraps
+
+import numpy as np
 import torch
+from torch import nn as nn
 from torch import optim as optim
 
 from models import get_models
+from utils.checkpoint import atomic_save, load_checkpoint
 
 
 def parse_train_args(arguments_string=None):
@@ -42,55 +48,174 @@ def parse_train_args(arguments_string=None):
     parser.add_argument('--G_step_every', default=1, type=int, help="Update G only evry 'G_step_every' iterations")
     parser.add_argument('--n_iterations', default=1000000, type=int)
     parser.add_argument('--no_fake_resample', default=False, action='store_true')
+    parser.add_argument('--micro_bs', default=None, type=int,
+                        help="Run network forwards/backwards in micro batches of this size and accumulate the gradients "
+                             "(not available with batch norm models)")
+    parser.add_argument('--ensemble', default=1, type=int,
+                        help="Train this many generators with different initializations at once (vmapped, see utils/ensemble.py)")
 
     # Evaluation
     parser.add_argument('--wandb', action='store_true', default=False, help="Otherwise use PLT localy")
     parser.add_argument('--log_freq', default=1000, type=int)
     parser.add_argument('--save_every', action='store_true', default=False)
+    parser.add_argument('--eval_worker_threads', default=0, type=int,
+                        help="Run evaluation in a separate process with this many threads (0 evaluates in the training loop)")
     parser.add_argument('--fid_freq', default=10000, type=int)
     parser.add_argument('--fid_n_batches', default=0, type=int, help="How many batches batches for reference FID"
                                                                      " statistics (0 turns off FID)")
+    parser.add_argument('--fid_weights', default=None, type=str, help="Path to a local InceptionV3 state_dict used for FID"
+                                                                     " (defaults to $INCEPTION_WEIGHTS)")
 
     # Other
     parser.add_argument('--project_name', default='train_results')
     parser.add_argument('--train_name', default=None)
     parser.add_argument('--n_workers', default=4, type=int)
+    parser.add_argument('--prefetch', default=2, type=int, help="Number of batches loaded ahead of the training step")
+    parser.add_argument('--data_seed', default=0, type=int, help="Seed of the order in which the data is sampled")
     parser.add_argument('--loadG', default=None, type=str)
     parser.add_argument('--resume_last_ckpt', action='store_true', default=False,
-                        help="Search for the latest ckpt in the same folder to resume training")
+                        help="Search for the latest ckpt in the same folder and resume training exactly where it stopped")
+    parser.add_argument('--keep_last_ckpts', default=0, type=int,
+                        help="Number of most recent checkpoints to keep with --save_every (0 keeps all)")
     parser.add_argument('--load_data_to_memory', action='store_true', default=False)
     parser.add_argument('--device', default="cuda:0")
-
-    if arguments_string is not None:
+    parser.add_argument('--memory_format', default='contiguous', choices=['contiguous', 'channels_last'],
+                        help="Memory format of the models and image batches (channels_last is faster with oneDNN on CPU)")
+    parser.add_argument('--profile', action='store_true', default=False,
+                        help="Time the phases of the training loop and log their summary every 100 iterations")
+    parser.add_argument('--profile_window', default=None, type=str,
+                        help="'<start>:<end>' iterations to record a torch.profiler Chrome trace for")
+    parser.add_argument('--compile', action='store_true', default=False,
+                        help="torch.compile netG, netD (unless --gp_weight > 0) and the loss (falls back to eager "
+                             "mode if compilation fails)")
+    parser.add_argument('--amp', default=None, choices=['bf16', 'fp16'],
+                        help="Autocast G/D forwards to lower precision (distribution metrics stay in float32)")
+
+    if isinstance(arguments_string, str):  # Otherwise a list of arguments
         arguments_string = arguments_string.split()
 
     return parser.parse_args(arguments_string)
 
 
-def copy_G_params(model):
-    flatten = deepcopy(list(p.data for p in model.parameters()))
-    return flatten
-
-
-def load_params(model, new_param):
-    for p, new_p in zip(model.parameters(), new_param):
-        p.data.copy_(new_p)
+class EMA:
+    """
+    Exponential moving average of the generator parameters kept in a separate shadow generator updated with foreach ops.
+    With update_factor=1 (no averaging) no shadow is kept and 'model' is the trained generator itself
+    """
+    def __init__(self, netG, update_factor):
+        self.netG = netG
+        self.update_factor = update_factor
+        self.shadow = None
+        if update_factor < 1:
+            self.shadow = deepcopy(netG)
+            self.shadow.__dict__.pop('forward', None)  # Don't share a compiled forward with netG
+            self.shadow.requires_grad_(False)
+            self.params = list(netG.parameters())
+            self.shadow_params = list(self.shadow.parameters())
+            self.buffers = list(netG.buffers())
+            self.shadow_buffers = list(self.shadow.buffers())
+
+    @property
+    def model(self):
+        return self.netG if self.shadow is None else self.shadow
+
+    @torch.no_grad()
+    def update(self):
+        if self.shadow is None:
+            return
+        torch._foreach_mul_(self.shadow_params, 1 - self.update_factor)
+        torch._foreach_add_(self.shadow_params, self.params, alpha=self.update_factor)
+        for b, shadow_b in zip(self.buffers, self.shadow_buffers):
+            shadow_b.copy_(b)
+
+    def load_state_dict(self, state_dict):
+        if self.shadow is not None:
+            self.shadow.load_state_dict(state_dict)
+
+
+def get_rng_state():
+    """RNG states of python, numpy and torch (numpy's key is stored as a tensor so checkpoints load with weights_only)"""
+    name, keys, pos, has_gauss, cached_gaussian = np.random.get_state()
+    state = {'python': random.getstate(),
+             'numpy': (name, torch.from_numpy(keys.astype(np.int64)), pos, has_gauss, cached_gaussian),
+             'torch': torch.get_rng_state()}
+    if torch.cuda.is_available():
+        state['cuda'] = torch.cuda.get_rng_state_all()
+    return state
+
+
+def set_rng_state(state):
+    random.setstate(state['python'])
+    name, keys, pos, has_gauss, cached_gaussian = state['numpy']
+    np.random.set_state((name, keys.cpu().numpy().astype(np.uint32), pos, has_gauss, cached_gaussian))
+    torch.set_rng_state(state['torch'].cpu())
+    if 'cuda' in state and torch.cuda.is_available():
+        torch.cuda.set_rng_state_all([s.cpu() for s in state['cuda']])
+
+
+def compile_with_fallback(fn, name, **compile_kwargs):
+    """torch.compile 'fn' and permanently fall back to eager execution if compilation fails. Only compiler failures
+    are caught (errors of the model itself are raised) and the backward graphs are compiled together with the forward
+    ones so that their compilation failures are caught here too instead of in loss.backward()"""
+    import torch._functorch.config
+    from torch._dynamo.exc import BackendCompilerFailed, InternalTorchDynamoError, Unsupported
+    if hasattr(torch._functorch.config, 'force_non_lazy_backward_lowering'):
+        torch._functorch.config.force_non_lazy_backward_lowering = True
+    compiled = [torch.compile(fn, **compile_kwargs)]
+
+    @wraps(fn)
+    def wrapper(*args, **kwargs):
+        if compiled[0] is None:
+            return fn(*args, **kwargs)
+        try:
+            return compiled[0](*args, **kwargs)
+        except (BackendCompilerFailed, InternalTorchDynamoError, Unsupported) as e:
+            print(f"Compiling {name} failed, falling back to eager mode: {e}")
+            compiled[0] = None
+            return fn(*args, **kwargs)
+    return wrapper
+
+
+def compile_models(netG, netD, loss_function, gp_weight=0):
+    """Compile the forward functions of the nets (as instance attributes, so that state dicts and checkpoints keep
+    their plain parameter names) and the compute functions of the loss.
+    netD stays in eager mode with a gradient penalty: compiled graphs don't support its double backward"""
+    netG.forward = compile_with_fallback(netG.forward, "netG")
+    if gp_weight > 0:
+        print("netD is not compiled: torch.compile does not support the double backward of the gradient penalty")
+    else:
+        netD.forward = compile_with_fallback(netD.forward, "netD")
+    # Multi-scale losses keep step counters: compile their stateless sub losses instead
+    for loss in getattr(loss_function, 'losses', [loss_function]):
+        if hasattr(loss, 'compute'):
+            loss.compute = compile_with_fallback(loss.compute, f"{type(loss).__name__}.compute")
 
 
 class Prior:
-    def __init__(self, prior_type, z_dim):
+    """
+    With a 'const=K' prior and use_indices=True (generators with 'takes_indices', e.g Pixels) the prior samples integer
+    indices of its K latents instead of the latents themselves
+    """
+    def __init__(self, prior_type, z_dim, use_indices=False):
         self.prior_type = prior_type
         self.z_dim = z_dim
         self.z = None
+        self.use_indices = False
         if "const" in self.prior_type:
             self.b = int(self.prior_type.split("=")[1])
+            self.use_indices = use_indices
+
+    def sample_indices(self, b):
+        return torch.arange(self.b) if b == self.b else torch.randint(self.b, (b,))
 
     def sample(self, b):
         if "const" in self.prior_type:
             if self.z is None:
-                self.z = torch.randn((self.b, self.z_dim))
+                self.z = torch.randn((self.b, self.z_dim))  # Kept with indices too so checkpoints have the same format
+            if self.use_indices:
+                return self.sample_indices(b)
             if b != self.b:
-                z = self.z[torch.randint(self.b, (b,))]
+                z = self.z[self.sample_indices(b)]
             else:
                 z = self.z
         elif self.prior_type == "binary":
@@ -102,52 +227,63 @@ class Prior:
         return z
 
 
-def save_model(prior, netG, netD, optimizerG, optimizerD, saved_model_folder, iteration, args):
+def save_model(prior, netG, netD, optimizerG, optimizerD, saved_model_folder, iteration, args, writer=None,
+               **training_state):
+    """Save a checkpoint through a CheckpointWriter if given (asynchronously) or atomically in place otherwise.
+    'training_state' holds everything else needed for an exact resume (RNG states, data position, ...)"""
     fname = f"{saved_model_folder}/{'last' if not args.save_every else iteration}.pth"
-    torch.save({"iteration": iteration,
-                'prior': prior.z,
-                'netG': netG.state_dict(),
-                'netD': netD.state_dict(),
-                "optimizerG": optimizerG.state_dict(),
-                "optimizerD": optimizerD.state_dict()
-                },
-               fname)
+    state = {"iteration": iteration,
+             'prior': prior.z,
+             'netG': netG.state_dict(),
+             'netD': netD.state_dict(),
+             "optimizerG": optimizerG.state_dict(),
+             "optimizerD": optimizerD.state_dict()
+             }
+    state.update(training_state)
+    if writer is not None:
+        writer.save(state, fname)
+    else:
+        atomic_save(state, fname)
 
 
 def get_models_and_optimizers(args, device, saved_model_folder):
-    prior = Prior(args.z_prior, args.z_dim)
-
+    """Returns the models, optimizers and the checkpoint training is resumed from (None if not resuming)"""
     netG, netD = get_models(args, device)
+    prior = Prior(args.z_prior, args.z_dim, use_indices=getattr(netG, 'takes_indices', False))
     netG.train()
     netD.train()
 
-    optimizerG = optim.Adam(netG.parameters(), lr=args.lrG, betas=(0.5, 0.9))
+    if getattr(netG, 'sparse', False):  # e.g Pixels-sparse=True: only update the moments and rows of sampled images
+        optimizerG = optim.SparseAdam(netG.parameters(), lr=args.lrG, betas=(0.5, 0.9))
+    else:
+        optimizerG = optim.Adam(netG.parameters(), lr=args.lrG, betas=(0.5, 0.9))
     optimizerD = optim.Adam(netD.parameters(), lr=args.lrD, betas=(0.5, 0.9))
 
     if args.loadG is not None:
-        ckpt = torch.load(args.loadG, map_location=args.device)
+        ckpt = load_checkpoint(args.loadG, map_location=args.device)
         netG.load_state_dict(ckpt['netG'])
         prior.z = ckpt['prior']
-    start_iteration = 0
+    resume_ckpt = None
     if args.resume_last_ckpt:
         ckpts = glob.glob(f'{saved_model_folder}/*.pth')
         if ckpts:
             latest_ckpt = max(ckpts, key = os.path.getctime)
-            ckpt = torch.load(latest_ckpt, map_location=args.device)
-            prior.z = ckpt['prior']
-            netG.load_state_dict(ckpt['netG'])
-            netD.load_state_dict(ckpt['netD'])
-            optimizerG.load_state_dict(ckpt['optimizerG'])
-            optimizerD.load_state_dict(ckpt['optimizerD'])
-            start_iteration = ckpt['iteration']
-            print(f"Loaded ckpt of iteration: {start_iteration}")
-    return prior, netG, netD, optimizerG, optimizerD, start_iteration
-
-
-def calc_gradient_penalty(netD, real_data, fake_data, one_sided=False):
-    """Ensure the netD is smooth by forcing the gradient between real and fake data to ahve norm of 1"""
+            resume_ckpt = load_checkpoint(latest_ckpt, map_location=args.device)
+            prior.z = resume_ckpt['prior']
+            # 'netG' holds the averaged weights when training with EMA
+            netG.load_state_dict(resume_ckpt.get('netG_train', resume_ckpt['netG']))
+            netD.load_state_dict(resume_ckpt['netD'])
+            optimizerG.load_state_dict(resume_ckpt['optimizerG'])
+            optimizerD.load_state_dict(resume_ckpt['optimizerD'])
+            print(f"Loaded ckpt of iteration: {resume_ckpt['iteration']}")
+    return prior, netG, netD, optimizerG, optimizerD, resume_ckpt
+
+
+def get_interpolates(real_data, fake_data, alpha=None):
+    """Random points on the lines between real and fake samples (leafs requiring grad)"""
     device = real_data.device
-    alpha = torch.rand(1, 1)
+    if alpha is None:
+        alpha = torch.rand(1, 1)
     alpha = alpha.expand(real_data.size())
     alpha = alpha.to(device)
 
@@ -155,19 +291,52 @@ def calc_gradient_penalty(netD, real_data, fake_data, one_sided=False):
 
     interpolates = interpolates.to(device)
     interpolates = torch.autograd.Variable(interpolates, requires_grad=True)
+    return interpolates
+
 
-    disc_interpolates = netD(interpolates)
+def penalize_gradients(disc_interpolates, interpolates, one_sided=False, scaler=None):
+    """Penalize the deviation from 1 of the norm of the gradients of netD at the interpolates
+    With an enabled GradScaler the double-backward is done on scaled outputs and the gradients are unscaled"""
+    scaled = scaler is not None and scaler.is_enabled()
+    if scaled:
+        disc_interpolates = scaler.scale(disc_interpolates)
 
     gradients = torch.autograd.grad(outputs=disc_interpolates,
                                     inputs=interpolates,
-                                    grad_outputs=torch.ones(disc_interpolates.size()).to(device),
+                                    grad_outputs=torch.ones_like(disc_interpolates),
                                     create_graph=True, retain_graph=True,
                                     only_inputs=True)[0]
+    if scaled:
+        gradients = gradients / scaler.get_scale()
 
-    gradients = gradients.view(gradients.shape[0], -1)
+    gradients = gradients.float().reshape(gradients.shape[0], -1)  # Gradients of channels_last inputs aren't viewable
     gradient_norm = gradients.norm(2, dim=1)
     diff = (gradient_norm - 1)
     if one_sided:
         diff = torch.clamp(diff, min=0)
     gradient_penalty = (diff ** 2).mean()
-    return gradient_penalty, gradient_norm.mean().item()
+    return gradient_penalty, gradient_norm.mean().detach()
+
+
+def calc_gradient_penalty(netD, real_data, fake_data, one_sided=False, scaler=None):
+    """Ensure the netD is smooth by forcing the gradient between real and fake data to ahve norm of 1"""
+    interpolates = get_interpolates(real_data, fake_data)
+    return penalize_gradients(netD(interpolates), interpolates, one_sided, scaler)
+
+
+def has_batch_norm(model):
+    return any(isinstance(m, nn.modules.batchnorm._BatchNorm) for m in model.modules())
+
+
+def calc_fused_wgan_gp(netD, real_data, fake_data, one_sided=False, scaler=None):
+    """
+    Compute the WGAN critic scores and the gradient penalty with a single netD forward on the concatenation of real,
+    fake and interpolated samples instead of three separate ones.
+    Only valid if netD processes samples independently (no batch norm) and real/fake batches have the same size
+    """
+    fake_data = fake_data.detach()
+    interpolates = get_interpolates(real_data, fake_data)
+    outputs = netD(torch.cat([real_data, fake_data, interpolates]))
+    real_scores, fake_scores, disc_interpolates = torch.split(outputs, [len(real_data), len(fake_data), len(interpolates)])
+    gradient_penalty, gradient_norm = penalize_gradients(disc_interpolates, interpolates, one_sided, scaler)
+    return real_scores.float().mean(), fake_scores.float().mean(), gradient_penalty, gradient_norm